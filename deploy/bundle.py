@@ -0,0 +1,179 @@
+"""Per-function bundles of src/lambdas for deploy.py.
+
+Every function of template.yml gets a zip with only the modules its
+handler imports, plus .pyc files compiled by an interpreter of the
+function's runtime. The build hash covers the sources of every bundle,
+so an unchanged tree gives the same hash and deploy.py can skip the
+upload and the stack update.
+"""
+import ast
+import hashlib
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+import zipfile
+
+# Fixed timestamp so the same files always give the same zip
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+# Unchecked hash pycs are used without comparing them to the source mtime,
+# which the zip extracted by Lambda does not keep
+COMPILE_SCRIPT = """
+import importlib.util, os, py_compile, sys
+source_folder, bundle_folder = sys.argv[1], sys.argv[2]
+for module in sys.argv[3:]:
+    py_compile.compile(
+        os.path.join(source_folder, module + ".py"),
+        cfile=importlib.util.cache_from_source(os.path.join(bundle_folder, module + ".py")),
+        dfile=module + ".py",
+        doraise=True,
+        invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+    )
+"""
+
+IMPORT_TIME_SCRIPT = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+__import__(sys.argv[2])
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def findHandlers(template):
+    # Modules of the Handler: <module>.lambda_handler entries and their runtime
+    with open(template) as template_fileobj:
+        template_data = template_fileobj.read()
+    handlers = sorted(set(re.findall(r"Handler:\s*(\w+)\.lambda_handler", template_data)))
+    runtimes = set(re.findall(r"Runtime:\s*(python\d\.\d+)", template_data))
+    if len(runtimes) != 1:
+        raise ValueError("Expected one python runtime in {}, found {}".format(template, sorted(runtimes)))
+    return handlers, runtimes.pop()
+
+
+def localImports(folder, module):
+    with open(os.path.join(folder, module + ".py")) as source:
+        tree = ast.parse(source.read())
+    imported = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imported.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module != None:
+            imported.add(node.module.split(".")[0])
+    return set(name for name in imported if os.path.isfile(os.path.join(folder, name + ".py")))
+
+
+def dynamicImports(folder):
+    # router imports the handlers by name when a request arrives
+    spec = importlib.util.spec_from_file_location("router", os.path.join(folder, "router.py"))
+    router = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(router)
+    return {"router": set(router.ROUTES.values()) | set([router.SCHEDULED_MODULE])}
+
+
+def moduleClosure(folder, module, dynamic):
+    modules = set()
+    pending = [module]
+    while len(pending) != 0:
+        current = pending.pop()
+        if current in modules:
+            continue
+        modules.add(current)
+        pending.extend(localImports(folder, current) | dynamic.get(current, set()))
+    return sorted(modules)
+
+
+def findCompiler(runtime):
+    # BUBBLE_PYTHON, this interpreter or pythonX.Y on PATH, whichever is the runtime's version
+    version = runtime[len("python"):]
+    candidates = [os.environ.get("BUBBLE_PYTHON"), sys.executable, runtime]
+    for candidate in candidates:
+        if candidate == None:
+            continue
+        try:
+            result = subprocess.run(
+                [candidate, "-c", "import sys; print('%d.%d' % sys.version_info[:2])"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+            )
+        except OSError:
+            continue
+        if result.returncode == 0 and result.stdout.strip() == version:
+            return candidate
+    return None
+
+
+def sourceHash(folder, modules):
+    digest = hashlib.sha256()
+    for module in modules:
+        digest.update(module.encode('utf-8') + b"\0")
+        with open(os.path.join(folder, module + ".py"), "rb") as source:
+            digest.update(hashlib.sha256(source.read()).digest())
+    return digest.hexdigest()
+
+
+def buildHash(folder, bundles, runtime, compiler):
+    # Changes with any bundled source, the set of modules of a function,
+    # the runtime or whether bytecode is shipped
+    digest = hashlib.sha256()
+    digest.update("{}:{}\0".format(runtime, compiler != None).encode('utf-8'))
+    for handler in sorted(bundles):
+        digest.update("{}={}\0".format(handler, sourceHash(folder, bundles[handler])).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def writeZip(bundle_folder, zip_path):
+    files = []
+    for root, _, names in os.walk(bundle_folder):
+        for name in names:
+            path = os.path.join(root, name)
+            files.append((os.path.relpath(path, bundle_folder).replace(os.sep, "/"), path))
+
+    with zipfile.ZipFile(zip_path, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for arcname, path in sorted(files):
+            info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as source:
+                archive.writestr(info, source.read())
+    return len(files)
+
+
+def buildBundle(folder, handler, modules, compiler, build_folder, build_hash):
+    bundle_folder = os.path.join(build_folder, handler)
+    os.makedirs(bundle_folder)
+    for module in modules:
+        with open(os.path.join(folder, module + ".py"), "rb") as source:
+            data = source.read()
+        with open(os.path.join(bundle_folder, module + ".py"), "wb") as target:
+            target.write(data)
+
+    if compiler != None:
+        subprocess.run([compiler, "-c", COMPILE_SCRIPT, folder, bundle_folder] + modules, check=True)
+
+    zip_path = os.path.join(build_folder, bundleName(handler, build_hash))
+    writeZip(bundle_folder, zip_path)
+    return bundle_folder, zip_path
+
+
+def bundleName(handler, build_hash):
+    return "{}-{}.zip".format(handler, build_hash)
+
+
+def measureImportTime(python, bundle_folder, handler):
+    # Fresh interpreter per run so nothing is imported already. The first run
+    # leaves the bytecode of python behind if the bundle has none for it, the
+    # second one is what is reported. boto3 only needs a region to build its
+    # clients, no request is made
+    environment = dict(os.environ)
+    environment.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+    for run in range(2):
+        result = subprocess.run(
+            [python, "-c", IMPORT_TIME_SCRIPT, bundle_folder, handler],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, env=environment,
+        )
+        if result.returncode != 0:
+            lines = result.stderr.strip().splitlines()
+            return None, lines[-1] if len(lines) != 0 else "exit code {}".format(result.returncode)
+    return float(result.stdout.strip()), None
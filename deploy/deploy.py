@@ -1,6 +1,6 @@
-import zipfile
 import os
-import uuid
+import hashlib
+import tempfile
 import boto3 
 import logging
 import json
@@ -8,13 +8,15 @@ import sys
 import botocore
 from datetime import datetime
 
+import bundle
+
 cf = boto3.client('cloudformation')  # pylint: disable=C0103
 log = logging.getLogger('deploy.cf.create_or_update')  # pylint: disable=C0103
 
 def updateTemplate(stack_name, template, parameters):
     'Update or create stack'
 
-    template_data = _parse_template(template)
+    template_data = _parse_template(template, parameters)
     parameter_data = parameters
 
     params = {
@@ -48,13 +50,24 @@ def updateTemplate(stack_name, template, parameters):
         ))
 
 
-def _parse_template(template):
+def _parse_template(template, parameters):
     with open(template) as template_fileobj:
-        template_data = template_fileobj.read()
+        template_data = _deployment_template(template_fileobj.read(), parameters)
     cf.validate_template(TemplateBody=template_data)
     return template_data
 
 
+def _deployment_template(template_data, parameters):
+    # The stage serves the snapshot of the API taken when its Deployment was
+    # created, and CloudFormation only creates one when the logical ID changes.
+    # The ID carries a hash of the template and of the parameters (BuildHash,
+    # UseRouter...), so every change of the API or of its functions is served
+    values = sorted((p["ParameterKey"], p.get("ParameterValue")) for p in parameters
+                    if p["ParameterKey"] != "SessionSecret")
+    digest = hashlib.sha256((template_data + json.dumps(values)).encode('utf-8')).hexdigest()[:12]
+    return template_data.replace("ApiGatewayDeploymentBubble", "ApiGatewayDeploymentBubble" + digest)
+
+
 def _parse_parameters(parameters):
     with open(parameters) as parameter_fileobj:
         parameter_data = json.load(parameter_fileobj)
@@ -80,20 +93,71 @@ def json_serial(obj):
 
 
 
-lambdasFolder = "../src/lambdas/"
+def _stack_parameters(stack_name):
+    stacks = cf.describe_stacks(StackName=stack_name)['Stacks']
+    return {parameter['ParameterKey']: parameter.get('ParameterValue') for parameter in stacks[0].get('Parameters', [])}
 
-files = os.listdir(lambdasFolder)
 
+def _stack_template(stack_name):
+    return cf.get_template(StackName=stack_name, TemplateStage='Original')['TemplateBody']
 
-lamdasZipFileName = "lambas_" + str(uuid.uuid4()) + ".zip"
 
-with zipfile.ZipFile(lamdasZipFileName, mode="w") as archive:
-    for filename in files:
-        archive.write(lambdasFolder + filename, arcname=filename)
+def _s3_object_exists(s3, bucket, key):
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return False
+        raise
+    return True
 
-client = boto3.client("s3")
-client.upload_file(lamdasZipFileName, "zipfileuploaddeploy", "prefix/functions/packages/CleanupPV/"+lamdasZipFileName)
 
+lambdasFolder = "../src/lambdas/"
+bucketName = "zipfileuploaddeploy"
+packagesKey = "prefix/functions/packages/CleanupPV/"
+
+# One bundle per function with only the modules its handler imports
+handlers, runtime = bundle.findHandlers("template.yml")
+dynamic = bundle.dynamicImports(lambdasFolder)
+bundles = {handler: bundle.moduleClosure(lambdasFolder, handler, dynamic) for handler in handlers}
+
+compiler = bundle.findCompiler(runtime)
+if compiler == None:
+    print("No {} interpreter found (set BUBBLE_PYTHON), bundles are shipped without bytecode".format(runtime))
+
+buildHash = bundle.buildHash(lambdasFolder, bundles, runtime, compiler)
+print("Build {}".format(buildHash))
+
+buildFolder = tempfile.mkdtemp(prefix="bubble_build_")
+bundleFolders = {}
+zipPaths = {}
+for handler in handlers:
+    bundleFolders[handler], zipPaths[handler] = bundle.buildBundle(lambdasFolder, handler, bundles[handler], compiler, buildFolder, buildHash)
+
+# Import time of every handler from its own bundle, what a cold start pays
+# before the first request is handled. The runtime's interpreter is preferred
+# but it may not have boto3 installed
+for handler in handlers:
+    milliseconds, error = None, "no interpreter"
+    for python in [compiler, sys.executable]:
+        if python != None:
+            milliseconds, error = bundle.measureImportTime(python, bundleFolders[handler], handler)
+        if error == None:
+            break
+    if error != None:
+        print("{}: import failed: {}".format(handler, error))
+    else:
+        print("{}: import {:.1f} ms".format(handler, milliseconds))
+
+client = boto3.client("s3")
+for handler in handlers:
+    key = packagesKey + bundle.bundleName(handler, buildHash)
+    # Keys carry the build hash, an object already there has the same content
+    if _s3_object_exists(client, bucketName, key):
+        print("{}: {} modules, already uploaded".format(handler, len(bundles[handler])))
+    else:
+        client.upload_file(zipPaths[handler], bucketName, key)
+        print("{}: {} modules, uploaded {} bytes".format(handler, len(bundles[handler]), os.path.getsize(zipPaths[handler])))
 
 
 param = [
@@ -110,15 +174,50 @@ param = [
         "ResolvedValue": "prefix/"
     },
     {
-        "ParameterKey": "ZipFileName",
-        "ParameterValue": lamdasZipFileName,
+        "ParameterKey": "BuildHash",
+        "ParameterValue": buildHash,
         "UsePreviousValue": False,
-        "ResolvedValue": lamdasZipFileName
+        "ResolvedValue": buildHash
     }
 ]
 
-
-updateTemplate("bubble", "template.yml", param)
+# Keep the same secret between deploys or every session token is invalidated
+if "BUBBLE_SESSION_SECRET" in os.environ:
+    param.append({
+        "ParameterKey": "SessionSecret",
+        "ParameterValue": os.environ["BUBBLE_SESSION_SECRET"],
+        "UsePreviousValue": False,
+    })
+else:
+    param.append({
+        "ParameterKey": "SessionSecret",
+        "UsePreviousValue": True,
+    })
+
+# BUBBLE_USE_ROUTER=1 serves every path from the Router function (shared warm
+# containers), otherwise each path has its own function
+param.append({
+    "ParameterKey": "UseRouter",
+    "ParameterValue": "true" if os.environ.get("BUBBLE_USE_ROUTER", "") in ["1", "true"] else "false",
+    "UsePreviousValue": False,
+})
+
+stackName = "bubble"
+
+# Nothing to do when the stack already runs this build with the same template
+# and settings. SessionSecret is NoEcho and cannot be compared, set
+# BUBBLE_FORCE_DEPLOY=1 to push a new one with an unchanged build
+if _stack_exists(stackName) and "BUBBLE_FORCE_DEPLOY" not in os.environ:
+    current = _stack_parameters(stackName)
+    with open("template.yml") as template_fileobj:
+        sameTemplate = _stack_template(stackName) == _deployment_template(template_fileobj.read(), param)
+    sameParameters = all(current.get(p["ParameterKey"]) == p["ParameterValue"]
+                         for p in param if p["ParameterKey"] != "SessionSecret" and "ParameterValue" in p)
+    if sameTemplate and sameParameters:
+        print("Build {} is already deployed, no stack update".format(buildHash))
+        sys.exit(0)
+
+updateTemplate(stackName, "template.yml", param)
 
 
 
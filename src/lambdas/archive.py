@@ -0,0 +1,314 @@
+import base64
+import botocore
+import gzip
+import json
+import os
+import time
+import uuid
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from database import accounted, archiveDB, batchGetItems, client, gameDB
+from common import authenticateRequest, isConditionalCheckFailure, returnErrorMessage
+from journal import deleteJournal, readTail
+
+# FINISHED games get archive = PENDING (see play.saveGameState), the archiver
+# writes them with their journal to a file of the archive store, then leaves
+# them in gameDB for this many seconds (gameDB TTL on expires)
+ARCHIVE_HOT_TTL = 7 * 24 * 60 * 60
+
+# A game rehydrated from the archive is evicted again after this many seconds
+REHYDRATED_TTL = 24 * 60 * 60
+
+# Games written to one archive file
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_WORKERS = 16
+
+# Stop taking new batches when less than this is left of the invocation (ms)
+TIME_MARGIN = 20000
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+class DirectoryStore:
+    # Local stand-in for the bucket, ARCHIVE_DIR
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def put(self, key, body):
+        path = os.path.join(self.folder, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as archive_file:
+            archive_file.write(body)
+        os.replace(path + ".tmp", path)
+
+    def read(self, key, offset, length):
+        with open(os.path.join(self.folder, key), "rb") as archive_file:
+            archive_file.seek(offset)
+            return archive_file.read(length)
+
+
+class S3Store:
+    # ARCHIVE_BUCKET, objects move to infrequent access storage (see deploy/template.yml)
+
+    def __init__(self, bucket):
+        import boto3
+        self.bucket = bucket
+        self.s3 = boto3.client('s3')
+
+    def put(self, key, body):
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType="application/gzip")
+
+    def read(self, key, offset, length):
+        response = self.s3.get_object(Bucket=self.bucket, Key=key,
+                                      Range="bytes={}-{}".format(offset, offset + length - 1))
+        return response["Body"].read()
+
+
+def openArchiveStore():
+    # None if neither is configured
+    if os.environ.get("ARCHIVE_BUCKET", "") != "":
+        return S3Store(os.environ["ARCHIVE_BUCKET"])
+    if os.environ.get("ARCHIVE_DIR", "") != "":
+        return DirectoryStore(os.environ["ARCHIVE_DIR"])
+    return None
+
+
+def dumpAttribute(value):
+    # DynamoDB JSON, the format of the table exports to S3: binary as base64
+    if "B" in value:
+        return {"B": base64.b64encode(bytes(value["B"])).decode('ascii')}
+    if "BS" in value:
+        return {"BS": [base64.b64encode(bytes(member)).decode('ascii') for member in value["BS"]]}
+    if "M" in value:
+        return {"M": dict((name, dumpAttribute(member)) for name, member in value["M"].items())}
+    if "L" in value:
+        return {"L": [dumpAttribute(member) for member in value["L"]]}
+    return value
+
+
+def loadAttribute(value):
+    if "B" in value:
+        return {"B": base64.b64decode(value["B"])}
+    if "BS" in value:
+        return {"BS": [base64.b64decode(member) for member in value["BS"]]}
+    if "M" in value:
+        return {"M": dict((name, loadAttribute(member)) for name, member in value["M"].items())}
+    if "L" in value:
+        return {"L": [loadAttribute(member) for member in value["L"]]}
+    return value
+
+
+def dumpItem(item):
+    return dict((name, dumpAttribute(serializer.serialize(value))) for name, value in item.items())
+
+
+def loadItem(item):
+    return dict((name, deserializer.deserialize(loadAttribute(value))) for name, value in item.items())
+
+
+def archiveEntry(game, records):
+    # One line of an archive file as its own gzip member, so a game is read
+    # back with a ranged read of its bytes. The members of a file concatenated
+    # are one gzip stream of JSON lines
+    game = dict(game)
+    game.pop("archive", None)
+    line = json.dumps({
+        "game_id": game["game_id"],
+        "Item": dumpItem(game),
+        "journal": [dumpItem(record) for record in records],
+    }) + "\n"
+    return gzip.compress(line.encode('utf-8'))
+
+
+def findArchivableGames(limit, start_key=None):
+    query = {
+        "IndexName": "archive-index",
+        "KeyConditionExpression": Key('archive').eq('PENDING'),
+        "Limit": limit,
+    }
+    if start_key != None:
+        query["ExclusiveStartKey"] = start_key
+
+    response = gameDB.query(**query)
+    return [item["game_id"] for item in response["Items"]], response.get("LastEvaluatedKey")
+
+
+def markArchived(game, archive_key, offset, length, archived_at):
+    # The lookup entry and the TTL of the hot row in one write, only the
+    # first archiver to get there wins
+    try:
+        client.transact_write_items(TransactItems=[
+            {"Put": {
+                "TableName": archiveDB.name,
+                "Item": {
+                    "game_id": game["game_id"],
+                    "archive_key": archive_key,
+                    "offset": offset,
+                    "length": length,
+                    "archived_at": archived_at,
+                    "player_names": game["player_names"],
+                    "version": game.get("version", 0),
+                },
+            }},
+            {"Update": {
+                "TableName": gameDB.name,
+                "Key": {'game_id': game["game_id"]},
+                "UpdateExpression": "SET expires = :e REMOVE #a",
+                "ConditionExpression": "#a = :pending",
+                "ExpressionAttributeNames": {"#a": "archive"},
+                "ExpressionAttributeValues": {":e": archived_at + ARCHIVE_HOT_TTL, ":pending": "PENDING"},
+            }},
+        ])
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        return False
+
+    # The history is in the archive now
+    deleteJournal(game["game_id"])
+    return True
+
+
+def archiveBatch(store, game_ids, executor):
+    # Returns the number of games archived
+    games = [game for game in batchGetItems(gameDB, "game_id", game_ids).values()
+             if game.get("status") == "FINISHED" and game.get("archive") == "PENDING"]
+    if len(games) == 0:
+        return 0
+
+    journals = list(executor.map(lambda game: readTail(game["game_id"], 0), games))
+
+    members = [archiveEntry(game, records) for game, records in zip(games, journals)]
+    offsets = [sum(len(member) for member in members[:position]) for position in range(len(members))]
+
+    archived_at = int(time.time())
+    archive_key = "games/{}/{}.jsonl.gz".format(time.strftime("%Y/%m/%d", time.gmtime(archived_at)), uuid.uuid4())
+    store.put(archive_key, b"".join(members))
+
+    saved = executor.map(lambda position: markArchived(games[position], archive_key, offsets[position],
+                                                       len(members[position]), archived_at), range(len(games)))
+    return len([archived for archived in saved if archived])
+
+
+def archiveFinishedGames(store, context=None):
+    # Returns the number of games archived and whether every pending game was seen
+    archived = 0
+    start_key = None
+
+    with ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) as executor:
+        while True:
+            game_ids, start_key = findArchivableGames(ARCHIVE_BATCH_SIZE, start_key)
+            if len(game_ids) != 0:
+                archived += archiveBatch(store, game_ids, executor)
+
+            if start_key == None:
+                break
+            if context != None and context.get_remaining_time_in_millis() < TIME_MARGIN:
+                break
+
+    return archived, start_key == None
+
+
+def markFinishedGames():
+    # Games finished before the archive existed have no archive attribute,
+    # one scan queues them for the archiver
+    marked = 0
+    scan = {
+        "FilterExpression": Attr('status').eq('FINISHED') & Attr('archive').not_exists() & Attr('expires').not_exists(),
+        "ProjectionExpression": "game_id",
+    }
+    while True:
+        response = gameDB.scan(**scan)
+        for item in response["Items"]:
+            try:
+                gameDB.update_item(
+                    Key={'game_id': item["game_id"]},
+                    UpdateExpression="SET #a = :pending",
+                    ConditionExpression="#s = :finished AND attribute_not_exists(expires)",
+                    ExpressionAttributeNames={"#a": "archive", "#s": "status"},
+                    ExpressionAttributeValues={":pending": "PENDING", ":finished": "FINISHED"},
+                )
+                marked += 1
+            except botocore.exceptions.ClientError as ex:
+                if not isConditionalCheckFailure(ex):
+                    raise
+        if "LastEvaluatedKey" not in response:
+            return marked
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def jsonNumber(value):
+    # json.dumps default for the numbers boto3 reads
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def readArchivedGame(store, entry):
+    # The game item and its journal as they were archived
+    member = store.read(entry["archive_key"], int(entry["offset"]), int(entry["length"]))
+    archived = json.loads(gzip.decompress(member).decode('utf-8'))
+    return loadItem(archived["Item"]), [loadItem(record) for record in archived["journal"]]
+
+
+def rehydrateGame(user, game_id, history=False):
+    # Returns success, message and the answer. A game evicted from gameDB is
+    # written back from the archive for REHYDRATED_TTL, getGameStatus can then read it
+    response = archiveDB.get_item(Key={'game_id': game_id})
+    if "Item" not in response:
+        return False, "game_id is not archived", None
+    entry = response["Item"]
+
+    if user not in json.loads(entry["player_names"]):
+        return False, "User is not in game", None
+
+    answer = {"game_id": game_id, "archived_at": int(entry["archived_at"]), "rehydrated": False}
+
+    # Rows past their TTL can still be read until DynamoDB deletes them
+    now = int(time.time())
+    response = gameDB.get_item(Key={'game_id': game_id}, ProjectionExpression="expires")
+    hot = "Item" in response and int(response["Item"].get("expires", now + 1)) > now
+
+    records = None
+    if not hot or history:
+        store = openArchiveStore()
+        if store == None:
+            return False, "Archive is not available", None
+        game, records = readArchivedGame(store, entry)
+
+    if not hot:
+        game["expires"] = now + REHYDRATED_TTL
+        gameDB.put_item(Item=game)
+        answer["rehydrated"] = True
+
+    if history:
+        answer["journal"] = records
+
+    return True, "Ok", answer
+
+
+@accounted("archive")
+def lambda_handler(event, context):
+    params = event.get("queryStringParameters")
+    if params == None or "game_id" not in params:
+        return returnErrorMessage("Game_id is missing in request")
+
+    success, message, user = authenticateRequest(params)
+    if not success:
+        return returnErrorMessage(message)
+
+    success, message, answer = rehydrateGame(user, params["game_id"], params.get("history", "") == "true")
+    if not success:
+        return returnErrorMessage(message)
+
+    responseObject = {}
+    responseObject['statusCode'] = 200
+    responseObject['headers'] = {}
+    responseObject['headers']['Content-Type'] = 'application/json'
+    responseObject['body'] = json.dumps(answer, default=jsonNumber)
+
+    return responseObject
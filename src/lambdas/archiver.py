@@ -0,0 +1,22 @@
+import json
+from database import accounted
+from archive import archiveFinishedGames, markFinishedGames, openArchiveStore
+
+
+@accounted("archiver")
+def lambda_handler(event, context):
+    # Scheduled: moves the FINISHED games to the archive store, invoked once
+    # with {"backfill": true} it also queues the games finished before it existed
+    store = openArchiveStore()
+    if store == None:
+        raise Exception("ARCHIVE_BUCKET or ARCHIVE_DIR has to be set")
+
+    marked = 0
+    if event != None and event.get("backfill", False):
+        marked = markFinishedGames()
+
+    archived, complete = archiveFinishedGames(store, context)
+
+    result = {"archived": archived, "marked": marked, "complete": complete}
+    print(json.dumps(result))
+    return result
@@ -1,8 +1,29 @@
-import boto3
+import botocore
 import hashlib
+import hmac
+import base64
+import gzip
 import os
+import time
 from datetime import datetime
 import json
+from database import gameDB, playerDB
+from tracing import span
+
+# Session tokens are valid for this many seconds after login
+SESSION_TOKEN_TTL = 12 * 60 * 60
+
+# last_connection is written at most once per player in this interval (seconds)
+LAST_CONNECTION_INTERVAL = 5 * 60
+
+# player_id -> time of the last last_connection write done by this container
+lastConnectionWrites = {}
+
+# Bodies smaller than this (bytes) are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+
+# Called with (game_id, version) after every write to a game
+gameChangeListeners = []
 
 
 def checkAndExtractFromRequest(fields, request):
@@ -22,18 +43,17 @@ def checkAndExtractFromRequest(fields, request):
 def generateHashedPassword(password, salt = None):
     if salt == None:
         salt = os.urandom(32)
-    key = hashlib.pbkdf2_hmac(
-        'sha256', # The hash digest algorithm for HMAC
-        password.encode('utf-8'), # Convert the password to bytes
-        salt, # Provide the salt
-        100000 # It is recommended to use at least 100,000 iterations of SHA-256 
-    )
+    with span("password.hash"):
+        key = hashlib.pbkdf2_hmac(
+            'sha256', # The hash digest algorithm for HMAC
+            password.encode('utf-8'), # Convert the password to bytes
+            salt, # Provide the salt
+            100000 # It is recommended to use at least 100,000 iterations of SHA-256 
+        )
     return salt, key
 
 
 def checkUser(user, password):
-    dynamodb = boto3.resource('dynamodb')
-    playerDB = dynamodb.Table('playerDB')
 
     response = playerDB.get_item(Key={'player_id': user})
 
@@ -48,23 +68,251 @@ def checkUser(user, password):
 
         _, key = generateHashedPassword(password, salt)
 
-        print("User hash: " + user_hashed_pass)
-        print("New hash: " + key.hex())
-
-        if user_hashed_pass != key.hex():
-            print("Password is incorrect.")
+        if not hmac.compare_digest(user_hashed_pass, key.hex()):
             return False, "Password is incorrect."
         
         #Update last connection
+        touchLastConnection(playerDB, user)
+        return True, "Ok"
+    else:
+        return False, "User does not exist"
+
+
+def touchLastConnection(playerDB, user):
+    # Coalesce last_connection writes: polling clients would otherwise
+    # write the player item on every request
+    now = time.time()
+    if now - lastConnectionWrites.get(user, 0) < LAST_CONNECTION_INTERVAL:
+        return
+
+    playerDB.update_item(
+        Key={'player_id': user},
+        UpdateExpression="SET last_connection = :new_value",
+        ExpressionAttributeValues={":new_value": datetime.now().strftime("%d/%m/%Y %H:%M:%S")},
+    )
+    lastConnectionWrites[user] = now
+
+
+def isConditionalCheckFailure(ex):
+    return ex.response['Error']['Code'] == 'ConditionalCheckFailedException'
 
+
+def claimActiveGame(user, game_id):
+    # playerDB keeps the player's current game in active_game, so checking
+    # whether a player is already in a game is one keyed write instead of a scan
+    # A player who creates or joins a game is also taken out of the matchmaking queue
+
+    try:
         playerDB.update_item(
             Key={'player_id': user},
-            UpdateExpression="SET last_connection = :new_value",
-            ExpressionAttributeValues={":new_value": datetime.now().strftime("%d/%m/%Y %H:%M:%S")},
+            UpdateExpression="SET active_game = :g REMOVE matchmaking, queued_at",
+            ConditionExpression="attribute_not_exists(active_game) OR active_game = :g",
+            ExpressionAttributeValues={":g": game_id},
         )
         return True, "Ok"
+    except botocore.exceptions.ClientError as ex:
+        if not isConditionalCheckFailure(ex):
+            raise
+
+    # Take over the slot only if it points to a game that is gone or finished
+    response = playerDB.get_item(Key={'player_id': user}, ProjectionExpression="active_game")
+    current = response.get("Item", {}).get("active_game")
+    if current == None:
+        return False, "User is already in a game"
+
+    response = gameDB.get_item(
+        Key={'game_id': current},
+        ProjectionExpression="#s",
+        ExpressionAttributeNames={"#s": "status"},
+    )
+    if "Item" in response and response["Item"].get("status") != "FINISHED":
+        return False, "User is already in a game"
+
+    try:
+        playerDB.update_item(
+            Key={'player_id': user},
+            UpdateExpression="SET active_game = :g REMOVE matchmaking, queued_at",
+            ConditionExpression="active_game = :old",
+            ExpressionAttributeValues={":g": game_id, ":old": current},
+        )
+    except botocore.exceptions.ClientError as ex:
+        if not isConditionalCheckFailure(ex):
+            raise
+        return False, "User is already in a game"
+    return True, "Ok"
+
+
+def releaseActiveGame(users, game_id):
+    # Only clear active_game if it still points to this game
+
+    if isinstance(users, str):
+        users = [users]
+
+    for user in users:
+        try:
+            playerDB.update_item(
+                Key={'player_id': user},
+                UpdateExpression="REMOVE active_game",
+                ConditionExpression="active_game = :g",
+                ExpressionAttributeValues={":g": game_id},
+            )
+        except botocore.exceptions.ClientError as ex:
+            if not isConditionalCheckFailure(ex):
+                raise
+
+
+def getSessionSecret():
+    secret = os.environ.get("SESSION_SECRET", "")
+    if secret == "":
+        return None
+    return secret.encode('utf-8')
+
+
+def signSessionPayload(secret, payload):
+    return hmac.new(secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def generateSessionToken(user):
+    secret = getSessionSecret()
+    if secret == None:
+        return False, "Session tokens are not configured", None
+
+    expires = int(time.time()) + SESSION_TOKEN_TTL
+    encoded_user = base64.urlsafe_b64encode(user.encode('utf-8')).decode('ascii')
+    payload = encoded_user + "." + str(expires)
+    token = payload + "." + signSessionPayload(secret, payload)
+    return True, token, expires
+
+
+def checkSessionToken(token):
+    # Token is "<base64 user>.<expiry>.<hmac>", checked without touching the database
+    secret = getSessionSecret()
+    if secret == None:
+        return False, "Session tokens are not configured"
+
+    parts = token.split(".")
+    if len(parts) != 3:
+        return False, "Invalid token"
+    encoded_user, expires, signature = parts
+
+    payload = encoded_user + "." + expires
+    # compare_digest only takes ASCII str, a token can hold anything
+    if not hmac.compare_digest(signSessionPayload(secret, payload).encode('utf-8'), signature.encode('utf-8')):
+        return False, "Invalid token"
+
+    if not expires.isdigit() or int(expires) < time.time():
+        return False, "Token has expired"
+
+    try:
+        user = base64.urlsafe_b64decode(encoded_user.encode('ascii')).decode('utf-8')
+    except ValueError:
+        return False, "Invalid token"
+    return True, user
+
+
+def createUser(user, password):
+
+    salt, key = generateHashedPassword(password)
+
+    item = {}
+    item["player_id"] = user
+    item["hashed_pass"] = key.hex()
+    item["salt"] = salt.hex()
+    item["last_connection"] = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+
+    playerDB.put_item(Item=item)
+    lastConnectionWrites[user] = time.time()
+
+
+def authenticateRequest(params):
+    # Accepts either a session token or user and password
+    # Returns success, message and the authenticated user
+    if params != None and "token" in params:
+        success, result = checkSessionToken(params["token"])
+        if not success:
+            return False, result, None
+        touchLastConnection(playerDB, result)
+        return True, "Ok", result
+
+    if params != None and "user" in params:
+        user = params["user"]
+        if user == "":
+            return False, "User can't be empty", None
     else:
-        return False, "User does not exist"
+        return False, "User is missing in request", None
+
+    if params != None and "password" in params:
+        password = params["password"]
+        if password == "":
+            return False, "Password can't be empty", None
+    else:
+        return False, "Password is missing in request", None
+
+    success, message = checkUser(user, password)
+    if not success:
+        return False, message, user
+    return True, message, user
+
+def addGameChangeListener(listener):
+    gameChangeListeners.append(listener)
+
+
+def removeGameChangeListener(listener):
+    if listener in gameChangeListeners:
+        gameChangeListeners.remove(listener)
+
+
+def notifyGameChanged(game_id, version):
+    # Lets a server sharing this process push updates to waiting clients,
+    # on Lambda nothing is registered and waitForUpdate polls instead
+    for listener in list(gameChangeListeners):
+        listener(game_id, version)
+
+
+def getHeader(event, name):
+    # Header names are case insensitive and API Gateway passes them as the client sent them
+    headers = event.get("headers") or {}
+    name = name.lower()
+    for header, value in headers.items():
+        if header.lower() == name:
+            return value
+    return None
+
+
+def acceptsEncoding(event, encoding):
+    accept = getHeader(event, "Accept-Encoding")
+    if accept == None:
+        return False
+    for part in accept.split(","):
+        fields = part.strip().split(";")
+        if fields[0].strip().lower() != encoding:
+            continue
+        # gzip;q=0 means the client does not want it
+        for field in fields[1:]:
+            name, _, value = field.partition("=")
+            if name.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def compressResponse(event, responseObject):
+    # gzip large bodies for clients that accept it, API Gateway sends
+    # isBase64Encoded bodies as binary (BinaryMediaTypes in the template)
+    responseObject['headers']['Vary'] = 'Accept-Encoding'
+    body = responseObject.get('body')
+    if body == None or len(body) < COMPRESSION_MIN_SIZE or not acceptsEncoding(event, "gzip"):
+        return responseObject
+
+    with span("response.gzip", len(body)):
+        responseObject['body'] = base64.b64encode(gzip.compress(body.encode('utf-8'), 6)).decode('ascii')
+    responseObject['isBase64Encoded'] = True
+    responseObject['headers']['Content-Encoding'] = 'gzip'
+    return responseObject
+
 
 def returnErrorMessage(message):
     responseObject = {}
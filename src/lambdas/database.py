@@ -0,0 +1,147 @@
+import threading
+import time
+import boto3
+import tracing
+
+# Created once per container and shared by every handler
+dynamodb = boto3.resource('dynamodb')
+client = dynamodb.meta.client
+gameDB = dynamodb.Table('gameDB')
+playerDB = dynamodb.Table('playerDB')
+requestDB = dynamodb.Table('requestDB')
+journalDB = dynamodb.Table('journalDB')
+archiveDB = dynamodb.Table('archiveDB')
+leaderboardDB = dynamodb.Table('leaderboardDB')
+
+# BatchGetItem takes up to 100 keys per call
+BATCH_GET_SIZE = 100
+
+# Operations that accept ReturnConsumedCapacity
+CAPACITY_OPERATIONS = [
+    "GetItem", "PutItem", "UpdateItem", "DeleteItem", "Query", "Scan",
+    "BatchGetItem", "BatchWriteItem", "TransactGetItems", "TransactWriteItems",
+]
+
+
+class CallStats:
+    # DynamoDB calls, consumed capacity and latency of one handler invocation
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def record(self, operation, elapsed, capacity):
+        with self.lock:
+            stats = self.operations.setdefault(operation, {"calls": 0, "capacity": 0.0, "ms": 0.0})
+            stats["calls"] += 1
+            stats["capacity"] += capacity
+            stats["ms"] += elapsed * 1000
+
+    def summary(self):
+        with self.lock:
+            operations = {}
+            for operation, stats in self.operations.items():
+                operations[operation] = {
+                    "calls": stats["calls"],
+                    "capacity": round(stats["capacity"], 2),
+                    "ms": round(stats["ms"], 2),
+                }
+            return {
+                "calls": sum(stats["calls"] for stats in operations.values()),
+                "capacity": round(sum(stats["capacity"] for stats in operations.values()), 2),
+                "operations": operations,
+            }
+
+
+stats = CallStats()
+
+
+def requestCapacity(params, model, **kwargs):
+    if model.name in CAPACITY_OPERATIONS and "ReturnConsumedCapacity" not in params:
+        params["ReturnConsumedCapacity"] = "TOTAL"
+
+
+def startTimer(model, params, context, **kwargs):
+    context["dynamodb_request_bytes"] = len(params.get("body") or b"")
+    context["dynamodb_started"] = time.perf_counter()
+
+
+def recordCall(http_response, parsed, model, context, **kwargs):
+    elapsed = time.perf_counter() - context.get("dynamodb_started", time.perf_counter())
+    consumed = parsed.get("ConsumedCapacity", [])
+    # Single item operations return a dict, batch and transactions a list
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    capacity = sum(entry.get("CapacityUnits", 0) for entry in consumed)
+    stats.record(model.name, elapsed, capacity)
+    size = context.get("dynamodb_request_bytes", 0) + len(http_response.content or b"")
+    tracing.record("dynamodb." + model.name, elapsed, size)
+
+
+client.meta.events.register('provide-client-params.dynamodb.*', requestCapacity)
+client.meta.events.register('before-call.dynamodb.*', startTimer)
+client.meta.events.register('after-call.dynamodb.*', recordCall)
+
+
+def accounted(handler_name):
+    # Decorator for lambda_handler: resets the counters and prints one trace
+    # line with the spans and DynamoDB calls of the invocation (if sampled)
+    def decorator(handler):
+        def wrapper(event, context):
+            stats.reset()
+            trace = tracing.startTrace(handler_name)
+            response = None
+            try:
+                with tracing.span("handler"):
+                    response = handler(event, context)
+                return response
+            finally:
+                fields = {"dynamodb": stats.summary()}
+                if isinstance(response, dict) and "statusCode" in response:
+                    fields["status"] = response["statusCode"]
+                    fields["response_bytes"] = len(response.get("body") or "")
+                tracing.finishTrace(trace, **fields)
+        wrapper.__name__ = handler.__name__
+        wrapper.__wrapped__ = handler
+        return wrapper
+    return decorator
+
+
+def batchGetItems(table, key_name, keys, projection=None, names=None):
+    # Returns key -> item, duplicate keys are read once and missing keys are left out,
+    # a projection has to include key_name
+    keys = list(dict.fromkeys(keys))
+    items = {}
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {"Keys": [{key_name: key} for key in keys[start:start + BATCH_GET_SIZE]]}
+        if projection != None:
+            request["ProjectionExpression"] = projection
+        if names != None:
+            request["ExpressionAttributeNames"] = names
+        request_items = {table.name: request}
+
+        delay = 0.05
+        while len(request_items) != 0:
+            response = client.batch_get_item(RequestItems=request_items)
+            for item in response["Responses"].get(table.name, []):
+                items[item[key_name]] = item
+            request_items = response.get("UnprocessedKeys", {})
+            if len(request_items) != 0:
+                time.sleep(delay)
+                delay = min(delay * 2, 1)
+    return items
+
+
+def keyQuery(condition, values, **options):
+    # Query arguments with the key condition written as a string. boto3 turns
+    # Key() conditions into strings with one builder per client, shared by
+    # every thread using the client, so queries that run on worker threads
+    # (leaderboard shards, the archiver, tools/exportTables.py) are built here
+    query = dict(options)
+    query["KeyConditionExpression"] = condition
+    query["ExpressionAttributeValues"] = values
+    return query
@@ -0,0 +1,94 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+from database import accounted, batchGetItems, gameDB
+from common import releaseActiveGame, notifyGameChanged
+from engine import GameState
+from play import saveGameState
+
+
+# Games loaded and saved together
+BATCH_SIZE = 100
+SAVE_WORKERS = 16
+
+# Stop taking new batches when less than this is left of the invocation (ms)
+TIME_MARGIN = 20000
+
+
+def findYearEndGames(start_key=None):
+    # Games get year_end = PENDING when the last player passes (see play.saveGameState)
+    query = {
+        "IndexName": "year-end-index",
+        "KeyConditionExpression": Key('year_end').eq('PENDING'),
+        "Limit": BATCH_SIZE,
+    }
+    if start_key != None:
+        query["ExclusiveStartKey"] = start_key
+
+    response = gameDB.query(**query)
+    game_ids = [item["game_id"] for item in response['Items']]
+    return game_ids, response.get('LastEvaluatedKey')
+
+
+def loadGameStates(game_ids):
+    # A game where the year is over has no journal records after its snapshot
+    # (see journal.needsSnapshot), the snapshot alone is the game
+    states = []
+    for game in batchGetItems(gameDB, "game_id", game_ids).values():
+        if game.get("status") != "PLAYING":
+            continue
+        state = GameState.fromItem(game)
+        if state.isYearOver():
+            states.append(state)
+    return states
+
+
+def processGame(state):
+    # A play saved in between makes the conditional save fail, the game is
+    # then picked up again by the next run
+    loaded_version = state.version
+    finished = state.endOfYear()
+    if not saveGameState(state, loaded_version, "END_OF_YEAR"):
+        return state, False, False
+    return state, True, finished
+
+
+def processBatch(game_ids, executor):
+    processed = 0
+    finished_games = []
+    for state, saved, finished in executor.map(processGame, loadGameStates(game_ids)):
+        if not saved:
+            continue
+        processed += 1
+        notifyGameChanged(state.game_id, state.nextVersion())
+        if finished:
+            finished_games.append(state)
+
+    for state in finished_games:
+        releaseActiveGame(state.player_names, state.game_id)
+
+    return processed, len(finished_games)
+
+
+@accounted("endOfTurn")
+def lambda_handler(event, context):
+    processed = 0
+    finished = 0
+    start_key = None
+
+    with ThreadPoolExecutor(max_workers=SAVE_WORKERS) as executor:
+        while True:
+            game_ids, start_key = findYearEndGames(start_key)
+            if len(game_ids) != 0:
+                batch_processed, batch_finished = processBatch(game_ids, executor)
+                processed += batch_processed
+                finished += batch_finished
+
+            if start_key == None:
+                break
+            if context != None and context.get_remaining_time_in_millis() < TIME_MARGIN:
+                break
+
+    result = {"processed": processed, "finished": finished, "complete": start_key == None}
+    print(json.dumps(result))
+    return result
@@ -0,0 +1,279 @@
+import json
+from parameters import getParams
+from mapCodec import loadMap, loadTileVersions, emptyTileVersions, tileIndex
+
+
+def buildTileTable(per_level):
+    # Value of every (type, level) pair, indexed by type_code * (max_level + 1) + level
+    params = getParams()
+    width = params["max_level"] + 1
+    table = [0] * ((len(params["building_types"]) + 1) * width)
+    for type_code, building_type in enumerate(params["building_types"], 1):
+        for level in range(width):
+            table[type_code * width + level] = per_level[building_type] * level
+    return table
+
+
+class GameState:
+    # A game loaded in memory: actions are validated and applied here without
+    # touching the database, play.py saves the result in one conditional write
+
+    def __init__(self, game_id, player_names, map_size, tiles, tile_versions, turn, year, version, action_done, players, status="PLAYING"):
+        self.game_id = game_id
+        self.status = status
+        self.player_names = player_names
+        self.map_size = map_size
+        self.tiles = tiles
+        self.tile_versions = tile_versions
+        self.turn = turn
+        self.year = year
+        self.version = version
+        self.action_done = action_done
+        # player_id -> {"money", "debt", "accumulated_points", "version"}
+        self.players = players
+
+        self.changed_tiles = set()
+        self.changed_players = set()
+        # player_id -> points earned by the last endOfYear, saved to the leaderboard with the game
+        self.gained_points = {}
+
+        params = getParams()
+        self.building_types = params["building_types"]
+        self.building_cost = params["building_cost"]
+        self.max_level = params["max_level"]
+        self.destroy_refund = params["destroy_refund"]
+        self.max_debt = params["max_debt"]
+        self.interest_rate = params["interest_rate"]
+        self.interest_rate_change_year = params["interest_rate_change_year"]
+        self.finish_year = params["finish_year"]
+        self.value_table = buildTileTable(self.building_cost)
+        self.income_table = buildTileTable(params["building_income"])
+
+    @classmethod
+    def fromItem(cls, game, player_names=None, tiles=None, tile_versions=None):
+        # Already decoded player_names, tiles and tile_versions (see gameCache) are used as they are
+        if player_names == None:
+            player_names = json.loads(game["player_names"])
+        map_size = int(game["map_size"])
+        version = int(game.get("version", 0))
+
+        if tiles == None:
+            tiles = loadMap(game["map"], map_size, player_names)
+        if tile_versions == None and "tile_versions" in game:
+            tile_versions = loadTileVersions(game["tile_versions"], map_size)
+        elif tile_versions == None:
+            tile_versions = emptyTileVersions(map_size, version)
+
+        # player_state is written by startGame, games started before it existed
+        # begin again from the initial money
+        player_state = game.get("player_state", {})
+        players = {}
+        for name in player_names:
+            state = player_state.get(name, {"money": getParams()["initial_money"], "debt": 0, "accumulated_points": 0})
+            players[name] = {
+                "money": int(state["money"]),
+                "debt": int(state["debt"]),
+                "accumulated_points": int(state["accumulated_points"]),
+                "version": int(state.get("version", 0)),
+            }
+
+        return cls(game["game_id"], player_names, map_size, tiles, tile_versions,
+                   int(game["turn"]), int(game["year"]), version, bool(game.get("action_done", False)), players,
+                   game.get("status", "PLAYING"))
+
+    def dumpPlayerState(self):
+        # Value of the player_state attribute, changed players get the new version
+        for name in self.changed_players:
+            self.players[name]["version"] = self.nextVersion()
+        return self.players
+
+    def currentPlayer(self):
+        # turn goes from 1 to the number of players, past that the year is over
+        if self.turn < 1 or self.turn > len(self.player_names):
+            return None
+        return self.player_names[self.turn - 1]
+
+    def nextVersion(self):
+        return self.version + 1
+
+    def getTile(self, row, column):
+        index = tileIndex(self.map_size, row, column)
+        cells = self.map_size * self.map_size
+        return self.tiles[index], self.tiles[cells + index], self.tiles[2 * cells + index]
+
+    def setTile(self, row, column, type_code, level, owner_code):
+        index = tileIndex(self.map_size, row, column)
+        cells = self.map_size * self.map_size
+        self.tiles[index] = type_code
+        self.tiles[cells + index] = level
+        self.tiles[2 * cells + index] = owner_code
+        self.tile_versions[index] = self.nextVersion()
+        self.changed_tiles.add(index)
+
+    def changeMoney(self, user, money=0, debt=0):
+        player = self.players[user]
+        player["money"] += money
+        player["debt"] += debt
+        self.changed_players.add(user)
+
+    def checkTurn(self, user, board_action=False):
+        if self.currentPlayer() != user:
+            return False, "It is not your turn"
+        if board_action and self.action_done:
+            return False, "Action already done this turn"
+        return True, "Ok"
+
+    def checkCoordinates(self, row, column):
+        if row < 0 or column < 0 or row >= self.map_size or column >= self.map_size:
+            return False, "Coordinates are out of the map"
+        return True, "Ok"
+
+    def checkLevel(self, level):
+        if level < 1 or level > self.max_level:
+            return False, "Level must be between 1 and " + str(self.max_level)
+        return True, "Ok"
+
+    def passTurn(self, user):
+        success, message = self.checkTurn(user)
+        if not success:
+            return False, message
+        self.turn += 1
+        self.action_done = False
+        return True, "Turn passed"
+
+    def build(self, user, row, column, building_type, level):
+        for success, message in (self.checkTurn(user, True), self.checkCoordinates(row, column), self.checkLevel(level)):
+            if not success:
+                return False, message
+        if building_type not in self.building_types:
+            return False, "Unknown building type"
+
+        type_code, _, _ = self.getTile(row, column)
+        if type_code != 0:
+            return False, "Tile is not empty"
+
+        cost = self.building_cost[building_type] * level
+        if self.players[user]["money"] < cost:
+            return False, "Not enough money"
+
+        self.changeMoney(user, money=-cost)
+        self.setTile(row, column, self.building_types.index(building_type) + 1, level, self.player_names.index(user) + 1)
+        self.action_done = True
+        return True, "Built"
+
+    def upgrade(self, user, row, column, level):
+        for success, message in (self.checkTurn(user, True), self.checkCoordinates(row, column), self.checkLevel(level)):
+            if not success:
+                return False, message
+
+        type_code, current_level, owner_code = self.getTile(row, column)
+        if type_code == 0 or owner_code != self.player_names.index(user) + 1:
+            return False, "Tile is not yours"
+        if level <= current_level:
+            return False, "Level must be higher than the current one"
+
+        cost = self.building_cost[self.building_types[type_code - 1]] * (level - current_level)
+        if self.players[user]["money"] < cost:
+            return False, "Not enough money"
+
+        self.changeMoney(user, money=-cost)
+        self.setTile(row, column, type_code, level, owner_code)
+        self.action_done = True
+        return True, "Upgraded"
+
+    def destroy(self, user, row, column):
+        for success, message in (self.checkTurn(user, True), self.checkCoordinates(row, column)):
+            if not success:
+                return False, message
+
+        type_code, level, owner_code = self.getTile(row, column)
+        if type_code == 0 or owner_code != self.player_names.index(user) + 1:
+            return False, "Tile is not yours"
+
+        refund = int(self.building_cost[self.building_types[type_code - 1]] * level * self.destroy_refund)
+        self.changeMoney(user, money=refund)
+        self.setTile(row, column, 0, 0, 0)
+        self.action_done = True
+        return True, "Destroyed"
+
+    def askLoan(self, user, amount):
+        success, message = self.checkTurn(user)
+        if not success:
+            return False, message
+        if amount <= 0:
+            return False, "Amount must be positive"
+        if self.players[user]["debt"] + amount > self.max_debt:
+            return False, "Debt can't be higher than " + str(self.max_debt)
+
+        self.changeMoney(user, money=amount, debt=amount)
+        return True, "Loan granted"
+
+    def payLoan(self, user, amount):
+        success, message = self.checkTurn(user)
+        if not success:
+            return False, message
+        if amount <= 0:
+            return False, "Amount must be positive"
+        if amount > self.players[user]["debt"]:
+            return False, "Amount is higher than the debt"
+        if amount > self.players[user]["money"]:
+            return False, "Not enough money"
+
+        self.changeMoney(user, money=-amount, debt=-amount)
+        return True, "Loan paid"
+
+    def sumByOwner(self, table):
+        # One pass over the three planes, adding table[type, level] to its owner
+        cells = self.map_size * self.map_size
+        width = self.max_level + 1
+        totals = [0] * 256
+        tiles = self.tiles
+        for type_code, level, owner_code in zip(tiles[:cells], tiles[cells:2 * cells], tiles[2 * cells:]):
+            totals[owner_code] += table[type_code * width + level]
+        return dict(zip(self.player_names, totals[1:len(self.player_names) + 1]))
+
+    def propertyValues(self):
+        return self.sumByOwner(self.value_table)
+
+    def incomes(self):
+        return self.sumByOwner(self.income_table)
+
+    def scores(self):
+        # Net worth: buildings at cost plus money minus debt
+        values = self.propertyValues()
+        scores = {}
+        for name in self.player_names:
+            player = self.players[name]
+            scores[name] = values[name] + player["money"] - player["debt"]
+        return scores
+
+    def isYearOver(self):
+        # Every player has passed, endOfTurn has to run before anyone can play
+        return self.status == "PLAYING" and self.currentPlayer() == None
+
+    def interestRate(self):
+        changes = len([year for year in self.interest_rate_change_year if self.year >= year])
+        return self.interest_rate[changes]
+
+    def endOfYear(self):
+        # Interest on debt, building income and points for every player,
+        # then the next year starts or the game finishes at finish_year
+        rate = self.interestRate()
+        incomes = self.incomes()
+        for name in self.player_names:
+            player = self.players[name]
+            player["debt"] += int(player["debt"] * rate)
+            player["money"] += incomes[name]
+
+        scores = self.scores()
+        for name in self.player_names:
+            self.gained_points[name] = max(scores[name], 0) // 100
+            self.players[name]["accumulated_points"] += self.gained_points[name]
+            self.changed_players.add(name)
+
+        self.year += 1
+        self.turn = 1
+        self.action_done = False
+        if self.year >= self.finish_year:
+            self.status = "FINISHED"
+        return self.status == "FINISHED"
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from mapCodec import loadMap, loadTileVersions, emptyTileVersions
+from engine import GameState
+
+
+# Games kept decoded per container, least recently used are dropped first
+GAME_CACHE_SIZE = 256
+
+# Entries older than this (s) are read again even if nothing says they are stale
+GAME_CACHE_TTL = 300
+
+
+class CachedGame:
+    # A game item as read from gameDB plus its decoded map, shared between
+    # requests so nothing in it may be modified
+
+    def __init__(self, item):
+        self.item = item
+        self.game_id = item["game_id"]
+        self.version = int(item.get("version", 0))
+        self.player_names = json.loads(item["player_names"])
+        self.map_size = int(item["map_size"])
+        self.tiles = loadMap(item["map"], self.map_size, self.player_names)
+        if "tile_versions" in item:
+            self.tile_versions = loadTileVersions(item["tile_versions"], self.map_size)
+        else:
+            self.tile_versions = None
+        self.cached_at = time.monotonic()
+
+    def toGameState(self):
+        # Copies of the arrays, the state is changed by the play being applied
+        if self.tile_versions != None:
+            tile_versions = array('I', self.tile_versions)
+        else:
+            tile_versions = emptyTileVersions(self.map_size, self.version)
+        return GameState.fromItem(self.item, list(self.player_names), array('B', self.tiles), tile_versions)
+
+
+class GameCache:
+
+    def __init__(self, size=GAME_CACHE_SIZE, ttl=GAME_CACHE_TTL):
+        self.lock = threading.Lock()
+        self.size = size
+        self.ttl = ttl
+        self.games = OrderedDict()
+
+    def get(self, game_id, version=None):
+        # With version the entry is only returned if it is at that version,
+        # without it the caller has to validate it (e.g. with a conditional write)
+        with self.lock:
+            cached = self.games.get(game_id)
+            if cached == None:
+                return None
+            if time.monotonic() - cached.cached_at > self.ttl or (version != None and cached.version != version):
+                del self.games[game_id]
+                return None
+            self.games.move_to_end(game_id)
+            return cached
+
+    def put(self, item):
+        cached = CachedGame(item)
+        with self.lock:
+            current = self.games.get(cached.game_id)
+            # An older read finishing late must not replace a newer entry
+            if current != None and current.version > cached.version:
+                return current
+            self.games[cached.game_id] = cached
+            self.games.move_to_end(cached.game_id)
+            while len(self.games) > self.size:
+                self.games.popitem(last=False)
+        return cached
+
+    def update(self, game_id, loaded_version, updates, removed=()):
+        # Applies a write that succeeded on top of the entry it was made from
+        with self.lock:
+            cached = self.games.get(game_id)
+        if cached == None or cached.version != loaded_version:
+            self.invalidate(game_id)
+            return None
+        item = dict(cached.item)
+        item.update(updates)
+        for name in removed:
+            item.pop(name, None)
+        return self.put(item)
+
+    def invalidate(self, game_id):
+        with self.lock:
+            self.games.pop(game_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.games.clear()
+
+
+gameCache = GameCache()
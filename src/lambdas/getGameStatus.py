@@ -1,55 +1,150 @@
 import json
-import boto3
-from common import checkUser, returnErrorMessage
+from database import accounted, gameDB
+from common import authenticateRequest, returnErrorMessage, getHeader, compressResponse
 from parameters import getParams
+from mapCodec import mapView, changedTiles
+from gameCache import gameCache
+from journal import lastVersion, loadGameItem
+from tracing import span
 
-dynamodb = boto3.resource('dynamodb')
-gameDB = dynamodb.Table('gameDB')
-playerDB = dynamodb.Table('playerDB')
 
 
     
 
-def buildGameStatus(user, game_id):
-    response = gameDB.get_item(Key={'game_id': game_id})
+def checkGameVersion(user, game_id):
+    # Cheap reads of the fields needed to answer an unchanged poll: the last
+    # journal record has the version, and the copy this container keeps has
+    # the player names if it is at that version. Otherwise they come from a
+    # projected read of the snapshot
+    version = lastVersion(game_id)
+    cached = gameCache.get(game_id)
+    if version != None and cached != None and cached.version == version:
+        player_names = cached.player_names
+    else:
+        response = gameDB.get_item(
+            Key={'game_id': game_id},
+            ProjectionExpression="version, player_names",
+        )
 
-    if "Item" not in response:
-        return False, "game_id does not exist", None
-    
-    game = response["Item"]
+        if "Item" not in response:
+            return False, "game_id does not exist", None
+
+        player_names = json.loads(response["Item"]["player_names"])
+        version = max(version or 0, int(response["Item"].get("version", 0)))
+
+    if user not in player_names:
+        return False, "User is not in game", None
+
+    return True, "Ok", version
+
+
+def statusETag(game_id, version, map_format, since_version=None):
+    # The body only depends on the game version and on how it was asked for.
+    # Weak, the gzip and identity encodings of a body share it
+    tag = "{}.{}.{}".format(game_id, version, map_format)
+    if since_version != None:
+        tag += ".{}".format(since_version)
+    return 'W/"' + tag + '"'
+
+
+def matchesETag(if_none_match, etag):
+    # Weak comparison, as If-None-Match is compared
+    if if_none_match.strip() == "*":
+        return True
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def buildGameStatus(user, game_id, map_format="packed", since_version=None, version=None):
+    # With since_version only what changed after that version is returned,
+    # version is given when the caller has just read it with checkGameVersion
+    cached = gameCache.get(game_id)
+    if version == None and (since_version != None or cached != None):
+        # The cheap read also tells if the copy this container keeps is current
+        success, message, version = checkGameVersion(user, game_id)
+        if not success:
+            return False, message, None
+    if version != None:
+        if since_version == version:
+            return True, "Unchanged", {"unchanged": True, "version": version}
+        cached = gameCache.get(game_id, version)
+
+    if cached == None:
+        item = loadGameItem(game_id)
+
+        if item == None:
+            gameCache.invalidate(game_id)
+            return False, "game_id does not exist", None
+
+        cached = gameCache.put(item)
+
+    # The cached item is shared, the answer is built on a copy
+    game = dict(cached.item)
     game["players"] = int(game["players"])
     game["turn"] = int(game["turn"])
     game["year"] = int(game["year"])
     game["map_size"] = int(game["map_size"])
+    game["version"] = cached.version
+    if "created_at" in game:
+        game["created_at"] = int(game["created_at"])
 
-
-    player_names = json.loads(game["player_names"])
+    player_names = cached.player_names
     if user not in player_names:
         return False, "User is not in game", None
 
+    # Only a client that is behind can get a delta, anything else gets everything
+    delta = since_version != None and since_version < game["version"] and "tile_versions" in game
+
+    tiles = cached.tiles
+    if delta:
+        game["changed_tiles"] = changedTiles(tiles, cached.tile_versions, game["map_size"], player_names, since_version)
+        del game["map"]
+    else:
+        game["map"] = mapView(tiles, game["map_size"], player_names, map_format)
+        game["map_format"] = map_format
+    game.pop("tile_versions", None)
+    # TTL of archived games (archive.py) and the flags of the sparse indexes
+    # (lobby, year_end, archive, matched) are for the handlers only
+    for name in ["expires", "lobby", "year_end", "archive", "matched"]:
+        game.pop(name, None)
+    game["player_names"] = list(player_names)
+
+    # In-game player state is on the game item, playerDB (and the
+    # credentials in it) is never read here
+    player_state = game.pop("player_state", {})
     player_info = []
 
     for player in player_names:
-        response = playerDB.get_item(Key={'player_id': player})
-
-        if "Item" not in response:
-            return False, "Error in user database", None
-        
-        player_item = response["Item"]
-
-        del player_item["hashed_pass"]
-        del player_item["salt"]
-
-        player_item["money"] = int(player_item["money"])
-        player_item["debt"] = int(player_item["debt"])
-        player_item["accumulated_points"] = int(player_item["accumulated_points"])
-
-        player_info.append(player_item)
-
-    status = {"game": game, "players": player_info, "params": getParams()}
+        if player not in player_state:
+            continue
+        player_item = player_state[player]
+
+        if delta and int(player_item.get("version", 0)) <= since_version:
+            continue
+
+        player_info.append({
+            "player_id": player,
+            "money": int(player_item["money"]),
+            "debt": int(player_item["debt"]),
+            "accumulated_points": int(player_item["accumulated_points"]),
+            "version": int(player_item.get("version", 0)),
+        })
+
+    if delta:
+        status = {"game": game, "players": player_info, "delta": True, "since_version": since_version}
+    else:
+        status = {"game": game, "players": player_info, "params": getParams()}
 
     return True, "Ok", status
 
+@accounted("getGameStatus")
 def lambda_handler(event, context):
     
     if "queryStringParameters" in event:
@@ -57,43 +152,65 @@ def lambda_handler(event, context):
     else:
         return returnErrorMessage("No params")
 
-    if params != None and "user" in params:
-        user = params["user"]
-        if user == "":
-            return returnErrorMessage("User can't be empty")
-    else:
-        return returnErrorMessage("User is missing in request")
-
-    if params != None and "password" in params:
-        password = params["password"]
-        if password == "":
-            return returnErrorMessage("Password can't be empty")
-    else:
-        return returnErrorMessage("Password is missing in request")
 
     if params != None and "game_id" in params:
         game_id = params["game_id"]
     else:
         return returnErrorMessage("Game_id is missing in request")
 
-    success, message = checkUser(user, password)
+    success, message, user = authenticateRequest(params)
 
     if not success:
         return returnErrorMessage(message)
 
     
-    success, message, status = buildGameStatus(user, game_id)
+    map_format = "packed"
+    if "map_format" in params:
+        map_format = params["map_format"]
+        if map_format not in ["packed", "json"]:
+            return returnErrorMessage("map_format must be packed or json")
+
+    since_version = None
+    if "since_version" in params:
+        if not params["since_version"].isdigit():
+            return returnErrorMessage("since_version must be a number")
+        since_version = int(params["since_version"])
+
+    # A client that already has this version gets a 304 after the cheap read only
+    version = None
+    if_none_match = getHeader(event, "If-None-Match")
+    if if_none_match != None:
+        success, message, version = checkGameVersion(user, game_id)
+        if not success:
+            return returnErrorMessage(message)
+        etag = statusETag(game_id, version, map_format, since_version)
+        if matchesETag(if_none_match, etag):
+            responseObject = {}
+            responseObject['statusCode'] = 304
+            responseObject['headers'] = {}
+            responseObject['headers']['ETag'] = etag
+            responseObject['headers']['Vary'] = 'Accept-Encoding'
+            return responseObject
+
+    success, message, status = buildGameStatus(user, game_id, map_format, since_version, version)
 
     if not success:
         return returnErrorMessage(message)
     
     answer = {"message": message, "status": status}
+    if "unchanged" in status:
+        version = status["version"]
+    else:
+        version = status["game"]["version"]
 
     responseObject = {}
     responseObject['statusCode'] = 200
     responseObject['headers'] = {}
     responseObject['headers']['Content-Type'] = 'application/json'  
-    responseObject['body'] = json.dumps(answer)
+    responseObject['headers']['ETag'] = statusETag(game_id, version, map_format, since_version)
+    with span("response.encode") as current:
+        responseObject['body'] = json.dumps(answer)
+        current.size = len(responseObject['body'])
 
-    return responseObject
+    return compressResponse(event, responseObject)
 
@@ -0,0 +1,169 @@
+import botocore
+import hashlib
+import hmac
+import json
+import time
+from database import requestDB
+from common import checkSessionToken, checkUser, getSessionSecret, isConditionalCheckFailure, returnErrorMessage
+
+# Responses are replayed for this many seconds, requestDB deletes them
+# afterwards through its TTL on expires
+IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# A request that was claimed but never finished (the container died) blocks
+# its key for this many seconds, longer than the Timeout of modifyGame and
+# play (300s in deploy/template.yml)
+IDEMPOTENCY_LEASE = 360
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 128
+
+# Credentials and the key itself do not make a request different
+UNHASHED_PARAMS = ["token", "user", "password", "idempotency_key"]
+
+
+class IdempotentRequest:
+
+    def __init__(self, handler_name, user, key, params):
+        self.request_id = hashlib.sha256(json.dumps([handler_name, user, key]).encode('utf-8')).hexdigest()
+        self.user = user
+        fields = dict((name, value) for name, value in params.items() if name not in UNHASHED_PARAMS)
+        self.fingerprint = hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+        self.credential = None
+        self.response = None
+
+        # Lets a retry sent with the password skip PBKDF2, keyed with the
+        # session secret so the record does not hold a plain password hash
+        secret = getSessionSecret()
+        if "token" not in params and "password" in params and secret != None:
+            self.credential = hmac.new(secret, (self.request_id + params["password"]).encode('utf-8'),
+                                       hashlib.sha256).hexdigest()
+
+    def load(self, params):
+        # Returns success and message, response is set if the request was already answered
+        now = int(time.time())
+        response = requestDB.get_item(Key={'request_id': self.request_id}, ConsistentRead=True)
+        item = response.get("Item")
+        if item == None or int(item["expires"]) < now:
+            return True, "Ok"
+        # The request that claimed it died, claim takes the key over
+        if item["status"] != "DONE" and int(item.get("lease_until", 0)) < now:
+            return True, "Ok"
+
+        if item["fingerprint"] != self.fingerprint:
+            return False, "idempotency_key was already used for a different request"
+        if item["status"] != "DONE":
+            return False, "A request with this idempotency_key is still being processed"
+
+        # A token was checked already, a password is only checked again if it is not the original one
+        if "token" not in params:
+            stored = item.get("credential")
+            if stored == None or self.credential == None or not hmac.compare_digest(stored, self.credential):
+                success, message = checkUser(self.user, params["password"])
+                if not success:
+                    return False, message
+
+        self.response = json.loads(item["response"])
+        return True, "Ok"
+
+    def claim(self):
+        now = int(time.time())
+        item = {
+            "request_id": self.request_id,
+            "status": "PENDING",
+            "fingerprint": self.fingerprint,
+            "lease_until": now + IDEMPOTENCY_LEASE,
+            "expires": now + IDEMPOTENCY_TTL,
+        }
+        if self.credential != None:
+            item["credential"] = self.credential
+
+        try:
+            requestDB.put_item(
+                Item=item,
+                ConditionExpression="attribute_not_exists(request_id) OR expires < :now OR (#s = :pending AND lease_until < :now)",
+                ExpressionAttributeNames={"#s": "status"},
+                ExpressionAttributeValues={":now": now, ":pending": "PENDING"},
+            )
+        except botocore.exceptions.ClientError as ex:
+            if not isConditionalCheckFailure(ex):
+                raise
+            return False, "A request with this idempotency_key is still being processed"
+        return True, "Ok"
+
+    def store(self, responseObject):
+        requestDB.update_item(
+            Key={'request_id': self.request_id},
+            UpdateExpression="SET #s = :done, #r = :r REMOVE lease_until",
+            ExpressionAttributeNames={"#s": "status", "#r": "response"},
+            ExpressionAttributeValues={":done": "DONE", ":r": json.dumps(responseObject)},
+        )
+
+    def release(self):
+        # Errors are not replayed, the retry does the work again
+        requestDB.delete_item(
+            Key={'request_id': self.request_id},
+            ConditionExpression="#s = :pending",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={":pending": "PENDING"},
+        )
+
+
+def openIdempotentRequest(handler_name, params):
+    # Returns success, message and the request, None if there is no idempotency_key
+    # or no user to scope it to (the handler then refuses the request itself)
+    key = params["idempotency_key"]
+    if key == "" or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        return False, "idempotency_key must have 1 to {} characters".format(MAX_IDEMPOTENCY_KEY_LENGTH), None
+
+    if "token" in params:
+        success, user = checkSessionToken(params["token"])
+        if not success:
+            return False, user, None
+    elif "user" in params and params["user"] != "" and params.get("password", "") != "":
+        user = params["user"]
+    else:
+        return True, "Ok", None
+
+    request = IdempotentRequest(handler_name, user, key, params)
+    success, message = request.load(params)
+    if not success or request.response != None:
+        return success, message, request
+
+    success, message = request.claim()
+    if not success:
+        return False, message, None
+    return True, "Ok", request
+
+
+def idempotent(handler_name):
+    # Decorator for lambda_handler: with an idempotency_key parameter the
+    # successful response is stored, and a retry of the same request gets it
+    # back from one read without the handler running again
+    def decorator(handler):
+        def wrapper(event, context):
+            params = event.get("queryStringParameters")
+            if params == None or "idempotency_key" not in params:
+                return handler(event, context)
+
+            success, message, request = openIdempotentRequest(handler_name, params)
+            if not success:
+                return returnErrorMessage(message)
+            if request == None:
+                return handler(event, context)
+            if request.response != None:
+                return request.response
+
+            try:
+                response = handler(event, context)
+            except Exception:
+                request.release()
+                raise
+            if response.get("statusCode") == 200:
+                request.store(response)
+            else:
+                request.release()
+            return response
+        wrapper.__name__ = handler.__name__
+        wrapper.__wrapped__ = handler
+        return wrapper
+    return decorator
@@ -0,0 +1,171 @@
+import json
+import time
+from database import gameDB, journalDB, keyQuery
+from mapCodec import loadMap, dumpMap, loadTileVersions, dumpTileVersions, emptyTileVersions
+from tracing import span
+
+# Every change to a game is appended to journalDB as a record whose seq is
+# the game version it produced. Plays only write their record, the gameDB
+# item is a snapshot of the game rewritten at least every SNAPSHOT_INTERVAL
+# versions, and always when lobby, year_end or status change (the indexes and
+# the other handlers read those from the snapshot). A game is loaded as its
+# snapshot plus the records after it.
+SNAPSHOT_INTERVAL = 16
+
+# Reads of the snapshot when a concurrent lifecycle change is seen in the tail
+MAX_LOAD_ATTEMPTS = 3
+
+# Request parameters that are not part of the action
+UNRECORDED_PARAMS = ["token", "user", "password", "idempotency_key", "game_id", "action"]
+
+
+def journalRecord(game_id, seq, action, user=None, params=None):
+    # A lifecycle record only says what happened, its state is in the snapshot written with it
+    record = {"game_id": game_id, "seq": seq, "action": action, "at": int(time.time() * 1000)}
+    if user != None:
+        record["user"] = user
+    if params != None:
+        record["params"] = dict((name, value) for name, value in params.items() if name not in UNRECORDED_PARAMS)
+    return record
+
+
+def playRecord(state, action, user, params, removed):
+    # What a play changed: the small game attributes, the changed players and
+    # the changed tiles as [index, type, level, owner] codes
+    record = journalRecord(state.game_id, state.nextVersion(), action, user, params)
+    record["set"] = {"turn": state.turn, "action_done": state.action_done, "year": state.year, "status": state.status}
+    if state.isYearOver():
+        record["set"]["year_end"] = "PENDING"
+    if len(removed) != 0:
+        record["remove"] = list(removed)
+    if len(state.changed_players) != 0:
+        record["players"] = dict((name, state.players[name]) for name in state.changed_players)
+    if len(state.changed_tiles) != 0:
+        cells = state.map_size * state.map_size
+        record["tiles"] = [[index, state.tiles[index], state.tiles[cells + index], state.tiles[2 * cells + index]]
+                           for index in sorted(state.changed_tiles)]
+    return record
+
+
+def recordPut(record):
+    # Transaction item appending record, it fails if another request wrote that version first
+    return {"Put": {
+        "TableName": journalDB.name,
+        "Item": record,
+        "ConditionExpression": "attribute_not_exists(seq)",
+    }}
+
+
+def playingCheck(game_id):
+    # Transaction item for a record written without a snapshot: the game must
+    # still be in gameDB and being played (not deleted, finished or archived)
+    return {"ConditionCheck": {
+        "TableName": gameDB.name,
+        "Key": {"game_id": game_id},
+        "ConditionExpression": "attribute_exists(game_id) AND #s = :playing",
+        "ExpressionAttributeNames": {"#s": "status"},
+        "ExpressionAttributeValues": {":playing": "PLAYING"},
+    }}
+
+
+def needsSnapshot(state):
+    return (state.nextVersion() % SNAPSHOT_INTERVAL == 0 or state.isYearOver() or len(state.gained_points) != 0
+            or state.status != "PLAYING")
+
+
+def readTail(game_id, version):
+    records = []
+    query = keyQuery("game_id = :g AND seq > :v", {":g": game_id, ":v": version})
+    while True:
+        response = journalDB.query(**query)
+        records.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return records
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def replay(item, records):
+    # Applies the records to a copy of the snapshot item, the result has the
+    # attributes of a game item written at the last record's version
+    if len(records) == 0:
+        return item
+
+    with span("journal.replay", len(records)):
+        item = dict(item)
+        map_size = int(item["map_size"])
+        cells = map_size * map_size
+        tiles = loadMap(item["map"], map_size, json.loads(item["player_names"]))
+        if "tile_versions" in item:
+            tile_versions = loadTileVersions(item["tile_versions"], map_size)
+        else:
+            tile_versions = emptyTileVersions(map_size, int(item.get("version", 0)))
+        player_state = dict(item.get("player_state", {}))
+
+        for record in records:
+            seq = int(record["seq"])
+            item.update(record.get("set", {}))
+            for name in record.get("remove", []):
+                item.pop(name, None)
+            player_state.update(record.get("players", {}))
+            for index, type_code, level, owner_code in record.get("tiles", []):
+                index = int(index)
+                tiles[index] = int(type_code)
+                tiles[cells + index] = int(level)
+                tiles[2 * cells + index] = int(owner_code)
+                tile_versions[index] = seq
+            item["version"] = seq
+
+        item["map"] = dumpMap(tiles)
+        item["tile_versions"] = dumpTileVersions(tile_versions)
+        item["player_state"] = player_state
+    return item
+
+
+def loadGameItem(game_id):
+    # The game at its last version: one read of the snapshot and one query of
+    # the records after it. None if the game does not exist
+    for attempt in range(MAX_LOAD_ATTEMPTS):
+        response = gameDB.get_item(Key={'game_id': game_id})
+        if "Item" not in response:
+            return None
+        item = response["Item"]
+        records = readTail(game_id, int(item.get("version", 0)))
+
+        # A lifecycle record has no state to replay, the snapshot written with
+        # it was committed after the read above and is read again
+        lifecycle = [position for position, record in enumerate(records) if "set" not in record]
+        if len(lifecycle) == 0:
+            return replay(item, records)
+
+    # Still behind, the game as it was before that change (saves of it fail their condition)
+    return replay(item, records[:lifecycle[0]])
+
+
+def lastVersion(game_id):
+    # Version of the last record, None for games without any (written before the journal)
+    response = journalDB.query(**keyQuery(
+        "game_id = :g",
+        {":g": game_id},
+        ScanIndexForward=False,
+        ProjectionExpression="seq",
+        Limit=1,
+    ))
+    if len(response["Items"]) == 0:
+        return None
+    return int(response["Items"][0]["seq"])
+
+
+def deleteJournal(game_id):
+    keys = []
+    query = keyQuery("game_id = :g", {":g": game_id}, ProjectionExpression="game_id, seq")
+    while True:
+        response = journalDB.query(**query)
+        keys.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            break
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    with journalDB.batch_writer() as batch:
+        for key in keys:
+            batch.delete_item(Key={"game_id": key["game_id"], "seq": key["seq"]})
+    return len(keys)
@@ -0,0 +1,290 @@
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from database import accounted, batchGetItems, keyQuery, leaderboardDB, playerDB
+from common import authenticateRequest, returnErrorMessage
+
+
+# Players are spread over this many partitions of leaderboard-index so the
+# points written at the end of every year do not all go to one partition.
+# Changing it means rewriting leaderboard_shard on every ranked player
+LEADERBOARD_SHARDS = 8
+
+# Rank counters in leaderboardDB, see rankBucket. Players of the bucket of a
+# total are counted from the index, at most RANK_COUNT_LIMIT per shard
+RANK_BUCKET_STEPS = 8
+RANK_COUNT_LIMIT = 1000
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+DEFAULT_AROUND = 5
+MAX_AROUND = 25
+
+# Queries of the shards run in parallel, kept for the life of the container
+executor = ThreadPoolExecutor(max_workers=LEADERBOARD_SHARDS)
+
+
+def leaderboardShard(user):
+    return str(zlib.crc32(user.encode('utf-8')) % LEADERBOARD_SHARDS)
+
+
+def rankBucket(points):
+    # Counter of leaderboardDB that counts a total: one per total below
+    # 2 * RANK_BUCKET_STEPS, then RANK_BUCKET_STEPS buckets for every doubling
+    # of the points, so there are never more than a few hundred
+    shift = max(points.bit_length() - RANK_BUCKET_STEPS.bit_length(), 0)
+    return shift * RANK_BUCKET_STEPS + (points >> shift)
+
+
+def bucketBounds(bucket):
+    # Lowest and highest total counted by bucket
+    if bucket < 2 * RANK_BUCKET_STEPS:
+        return bucket, bucket
+    shift = bucket // RANK_BUCKET_STEPS - 1
+    start = bucket - shift * RANK_BUCKET_STEPS
+    return start << shift, ((start + 1) << shift) - 1
+
+
+def counterUpdate(shard, bucket, change):
+    return {"Update": {
+        "TableName": leaderboardDB.name,
+        "Key": {'leaderboard_shard': shard, 'points_bucket': bucket},
+        "UpdateExpression": "ADD players :c",
+        "ExpressionAttributeValues": {":c": change},
+    }}
+
+
+def rankedTotals(users):
+    # user -> total_points, None for players not ranked yet
+    items = batchGetItems(playerDB, "player_id", users, projection="player_id, total_points")
+    return dict((user, int(items[user]["total_points"]) if "total_points" in items.get(user, {}) else None)
+                for user in users)
+
+
+def pointsUpdates(gained_points, previous_totals):
+    # Transaction items adding the points of a year to the totals of the
+    # players, previous_totals are those totals as read before (see
+    # rankedTotals). A player is ranked from the first year they finish (see
+    # play.saveGameState), the counters of the rank buckets move with the
+    # totals in the same write
+    updates = []
+    changes = {}
+    for user in gained_points:
+        points = gained_points[user]
+        previous = previous_totals[user]
+        shard = leaderboardShard(user)
+        update = {
+            "TableName": playerDB.name,
+            "Key": {'player_id': user},
+            "UpdateExpression": "ADD total_points :p SET leaderboard_shard = :s",
+            "ExpressionAttributeValues": {":p": points, ":s": shard},
+        }
+        # Another write of the total in between would leave the counters wrong
+        if previous == None:
+            update["ConditionExpression"] = "attribute_not_exists(total_points)"
+        else:
+            update["ConditionExpression"] = "total_points = :previous"
+            update["ExpressionAttributeValues"][":previous"] = previous
+        updates.append({"Update": update})
+
+        if previous != None:
+            changes[(shard, rankBucket(previous))] = changes.get((shard, rankBucket(previous)), 0) - 1
+        bucket = rankBucket((previous or 0) + points)
+        changes[(shard, bucket)] = changes.get((shard, bucket), 0) + 1
+
+    # Players of one game can share a counter, a transaction may only write it once
+    for (shard, bucket), change in sorted(changes.items()):
+        if change != 0:
+            updates.append(counterUpdate(shard, bucket, change))
+    return updates
+
+
+def queryShards(points_operator=None, points=None, forward=False, limit=None):
+    # Runs the same Query on every shard and returns the entries (points, player_id) of each
+    def queryShard(shard):
+        condition = "leaderboard_shard = :s"
+        values = {":s": shard}
+        if points_operator != None:
+            condition += " AND total_points {} :p".format(points_operator)
+            values[":p"] = points
+        response = playerDB.query(**keyQuery(condition, values, IndexName="leaderboard-index",
+                                             ScanIndexForward=forward, Limit=limit))
+        return [(int(item["total_points"]), item["player_id"]) for item in response["Items"]]
+
+    results = list(executor.map(queryShard, [str(shard) for shard in range(LEADERBOARD_SHARDS)]))
+    return [entry for result in results for entry in result]
+
+
+def countAbove(points):
+    # Returns the number of players with more points than points, the number
+    # with exactly points and whether both are exact. The counters give the
+    # players of the buckets above, the players in the bucket of points are
+    # read from the index, at most RANK_COUNT_LIMIT per shard. Past that they
+    # are estimated as if spread evenly over the bucket
+    bucket = rankBucket(points)
+    low, high = bucketBounds(bucket)
+
+    def countShard(shard):
+        response = leaderboardDB.query(**keyQuery(
+            "leaderboard_shard = :s AND points_bucket >= :b",
+            {":s": shard, ":b": bucket},
+            ProjectionExpression="points_bucket, players",
+        ))
+        higher = sum(int(item["players"]) for item in response["Items"] if int(item["points_bucket"]) > bucket)
+        in_bucket = sum(int(item["players"]) for item in response["Items"] if int(item["points_bucket"]) == bucket)
+        if low == high:
+            return higher, in_bucket, True
+
+        response = playerDB.query(**keyQuery(
+            "leaderboard_shard = :s AND total_points BETWEEN :p AND :h",
+            {":s": shard, ":p": points, ":h": high},
+            IndexName="leaderboard-index",
+            ProjectionExpression="total_points",
+            Limit=RANK_COUNT_LIMIT,
+        ))
+        totals = [int(item["total_points"]) for item in response["Items"]]
+        above = len([total for total in totals if total > points])
+        ties = len(totals) - above
+        if "LastEvaluatedKey" not in response:
+            return higher + above, ties, True
+        return higher + max(above, in_bucket * (high - points) // (high - low + 1)), ties, False
+
+    results = list(executor.map(countShard, [str(shard) for shard in range(LEADERBOARD_SHARDS)]))
+    return (sum(result[0] for result in results), sum(result[1] for result in results),
+            all(result[2] for result in results))
+
+
+def rankEntry(rank, entry):
+    return {"rank": rank, "player_id": entry[1], "points": entry[0]}
+
+
+def topPlayers(limit):
+    # The best limit of every shard hold the best limit overall, players with
+    # the same points share their rank
+    entries = sorted(queryShards(limit=limit), key=lambda entry: (-entry[0], entry[1]))[:limit]
+    players = []
+    for position, entry in enumerate(entries):
+        if position > 0 and entry[0] == entries[position - 1][0]:
+            rank = players[-1]["rank"]
+        else:
+            rank = position + 1
+        players.append(rankEntry(rank, entry))
+    return players
+
+
+def playersAround(user, count):
+    # Returns success, message and the rank of the user with up to count
+    # players on each side of it. exact is False when a crowded bucket was estimated
+    response = playerDB.get_item(Key={'player_id': user}, ProjectionExpression="total_points")
+    if "total_points" not in response.get("Item", {}):
+        return False, "User is not ranked yet, players are ranked after their first year", None
+    points = int(response["Item"]["total_points"])
+
+    higher, ties, exact = countAbove(points)
+    rank = higher + 1
+
+    if count == 0:
+        return True, "Ok", {"rank": rank, "points": points, "exact": exact,
+                            "players": [rankEntry(rank, (points, user))]}
+
+    # Closest first on both sides, the nearest count of every shard hold the nearest count overall
+    above = sorted(queryShards(">", points, forward=True, limit=count))[:count]
+    tied = sorted(entry for entry in queryShards("=", points, limit=count + 1) if entry[1] != user)
+    below = sorted(queryShards("<", points, limit=count), key=lambda entry: (-entry[0], entry[1]))[:count]
+
+    # A player above is outranked by every higher one, those between it and the
+    # user are in above. When above was cut, some players with the points of
+    # the farthest one may be missing, so its rank is counted
+    farthest_rank = None
+    if len(above) == count:
+        farthest_higher, _, farthest_exact = countAbove(above[-1][0])
+        farthest_rank = farthest_higher + 1
+        exact = exact and farthest_exact
+
+    players = []
+    for entry in sorted(above, key=lambda entry: (-entry[0], entry[1])):
+        if farthest_rank != None and entry[0] == above[-1][0]:
+            entry_rank = farthest_rank
+        else:
+            entry_rank = rank - len([other for other in above if other[0] <= entry[0]])
+        players.append(rankEntry(entry_rank, entry))
+
+    mine = [(points, user)] + tied[:count]
+    for entry in sorted(mine, key=lambda entry: entry[1]):
+        players.append(rankEntry(rank, entry))
+
+    for entry in below:
+        between = len([other for other in below if other[0] > entry[0]])
+        players.append(rankEntry(rank + ties + between, entry))
+
+    return True, "Ok", {"rank": rank, "points": points, "exact": exact, "players": players}
+
+
+def rebuildRankCounters():
+    # Counts every ranked player again and overwrites the counters, for
+    # players ranked before leaderboardDB existed. Run it while no year ends
+    counters = {}
+    for shard in [str(shard) for shard in range(LEADERBOARD_SHARDS)]:
+        query = keyQuery("leaderboard_shard = :s", {":s": shard}, IndexName="leaderboard-index")
+        while True:
+            response = playerDB.query(**query)
+            for item in response["Items"]:
+                key = (shard, rankBucket(int(item["total_points"])))
+                counters[key] = counters.get(key, 0) + 1
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    # Buckets nobody is in anymore go back to 0
+    scan = {"ProjectionExpression": "leaderboard_shard, points_bucket"}
+    while True:
+        response = leaderboardDB.scan(**scan)
+        for item in response["Items"]:
+            counters.setdefault((item["leaderboard_shard"], int(item["points_bucket"])), 0)
+        if "LastEvaluatedKey" not in response:
+            break
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    with leaderboardDB.batch_writer() as batch:
+        for (shard, bucket), players in counters.items():
+            batch.put_item(Item={"leaderboard_shard": shard, "points_bucket": bucket, "players": players})
+    return len(counters)
+
+
+@accounted("leaderboard")
+def lambda_handler(event, context):
+    params = event.get("queryStringParameters")
+    if params == None:
+        params = {}
+
+    answer = {}
+    if "around" in params:
+        # Rank of the authenticated player and its neighbours
+        count = DEFAULT_AROUND
+        if params["around"] != "":
+            if not params["around"].isdigit():
+                return returnErrorMessage("around must be a number")
+            count = min(int(params["around"]), MAX_AROUND)
+
+        success, message, user = authenticateRequest(params)
+        if not success:
+            return returnErrorMessage(message)
+        success, message, around = playersAround(user, count)
+        if not success:
+            return returnErrorMessage(message)
+        answer["around"] = around
+    else:
+        limit = DEFAULT_LIMIT
+        if "limit" in params:
+            if not params["limit"].isdigit() or int(params["limit"]) == 0:
+                return returnErrorMessage("limit must be a positive number")
+            limit = min(int(params["limit"]), MAX_LIMIT)
+        answer["top"] = topPlayers(limit)
+
+    responseObject = {}
+    responseObject['statusCode'] = 200
+    responseObject['headers'] = {}
+    responseObject['headers']['Content-Type'] = 'application/json'
+    responseObject['body'] = json.dumps(answer)
+
+    return responseObject
@@ -1,22 +1,91 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Attr
+import base64
+from boto3.dynamodb.conditions import Key
+from database import accounted, gameDB
+from common import returnErrorMessage
 
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def encodeCursor(last_key):
+    # LastEvaluatedKey of lobby-index: game_id, lobby and created_at
+    last_key = {"game_id": last_key["game_id"], "lobby": last_key["lobby"], "created_at": int(last_key["created_at"])}
+    return base64.urlsafe_b64encode(json.dumps(last_key).encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor):
+    try:
+        last_key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except ValueError:
+        return None
+    if not isinstance(last_key, dict) or set(last_key) != {"game_id", "lobby", "created_at"}:
+        return None
+    # Anything encodeCursor could not have written would fail the Query
+    if not isinstance(last_key["game_id"], str) or last_key["game_id"] == "" or last_key["lobby"] != "WAITING":
+        return None
+    created_at = last_key["created_at"]
+    if not isinstance(created_at, int) or isinstance(created_at, bool) or created_at < 0 or created_at >= 10 ** 38:
+        return None
+    return last_key
+
+
+def listGames(limit, cursor):
+    # Games carry the sparse lobby attribute only while they can be joined,
+    # so this Query never reads started, full or finished games
+    query = {
+        "IndexName": "lobby-index",
+        "KeyConditionExpression": Key('lobby').eq('WAITING'),
+        "ProjectionExpression": "game_id, players, player_names, created_at",
+        "Limit": limit,
+    }
+    if cursor != None:
+        query["ExclusiveStartKey"] = cursor
+
+    response = gameDB.query(**query)
+
+    games = []
+    for item in response['Items']:
+        player_names = json.loads(item["player_names"])
+        games.append({
+            "game_id": item["game_id"],
+            "owner": player_names[0],
+            "player_names": player_names,
+            "players": int(item["players"]),
+            "created_at": int(item["created_at"]),
+        })
+
+    next_cursor = None
+    if 'LastEvaluatedKey' in response:
+        next_cursor = encodeCursor(response['LastEvaluatedKey'])
+
+    return games, next_cursor
+
+
+@accounted("listAvailableGames")
 def lambda_handler(event, context):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('gameDB')
-    print("EEEEE")
-    response = table.scan(FilterExpression=Attr('status').eq('WAITING') & Attr('players').lt(7))
+    params = event.get("queryStringParameters")
+    if params == None:
+        params = {}
 
-    data = response['Items']
+    limit = DEFAULT_LIMIT
+    if "limit" in params:
+        if not params["limit"].isdigit() or int(params["limit"]) == 0:
+            return returnErrorMessage("limit must be a positive number")
+        limit = min(int(params["limit"]), MAX_LIMIT)
 
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        data.extend(response['Items'])
+    cursor = None
+    if "cursor" in params and params["cursor"] != "":
+        cursor = decodeCursor(params["cursor"])
+        if cursor == None:
+            return returnErrorMessage("Invalid cursor")
 
+    games, next_cursor = listGames(limit, cursor)
 
     transactionResponse = {}
-    transactionResponse['data'] = str(data)
+    transactionResponse['games'] = games
+    transactionResponse['cursor'] = next_cursor
 
 
     responseObject = {}
@@ -25,4 +94,4 @@ def lambda_handler(event, context):
     responseObject['headers']['Content-Type'] = 'application/json'  
     responseObject['body'] = json.dumps(transactionResponse)
 
-    return responseObject
\ No newline at end of file
+    return responseObject
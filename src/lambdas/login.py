@@ -0,0 +1,39 @@
+import json
+from database import accounted
+from common import authenticateRequest, createUser, generateSessionToken, returnErrorMessage
+
+
+@accounted("login")
+def lambda_handler(event, context):
+
+    if "queryStringParameters" in event:
+        params = event["queryStringParameters"]
+    else:
+        return returnErrorMessage("No params")
+
+    # Password is checked once here, later requests send the token instead
+    if params != None and "token" in params:
+        return returnErrorMessage("Login requires user and password")
+
+    success, message, user = authenticateRequest(params)
+
+    if not success:
+        if message == "User does not exist":
+            createUser(user, params["password"])
+        else:
+            return returnErrorMessage(message)
+
+    success, token, expires = generateSessionToken(user)
+
+    if not success:
+        return returnErrorMessage(token)
+
+    answer = {"message": "Logged in", "user": user, "token": token, "expires": expires}
+
+    responseObject = {}
+    responseObject['statusCode'] = 200
+    responseObject['headers'] = {}
+    responseObject['headers']['Content-Type'] = 'application/json'
+    responseObject['body'] = json.dumps(answer)
+
+    return responseObject
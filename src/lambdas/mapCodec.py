@@ -0,0 +1,174 @@
+import json
+import base64
+import sys
+from array import array
+from parameters import getParams
+from tracing import span
+
+# The map is stored as a DynamoDB Binary attribute holding three planes of
+# map_size * map_size unsigned bytes, row by row:
+#   type plane:  0 = empty, n = building_types[n - 1]
+#   level plane: 0 = no level, otherwise the level
+#   owner plane: 0 = no owner, n = player_names[n - 1]
+TYPE_PLANE = 0
+LEVEL_PLANE = 1
+OWNER_PLANE = 2
+PLANES = 3
+
+
+def emptyMap(map_size):
+    return array('B', bytes(PLANES * map_size * map_size))
+
+
+def planeOffset(map_size, plane):
+    return plane * map_size * map_size
+
+
+def tileIndex(map_size, row, column):
+    return row * map_size + column
+
+
+def getTile(tiles, map_size, row, column, player_names):
+    index = tileIndex(map_size, row, column)
+    cells = map_size * map_size
+    return tileToDict(tiles[index], tiles[cells + index], tiles[2 * cells + index], player_names)
+
+
+def setTile(tiles, map_size, row, column, tile, player_names):
+    index = tileIndex(map_size, row, column)
+    cells = map_size * map_size
+    tiles[index], tiles[cells + index], tiles[2 * cells + index] = tileToCodes(tile, player_names)
+
+
+def tileToDict(type_code, level, owner_code, player_names):
+    building_types = getParams()["building_types"]
+
+    tile = {"type": None, "level": None, "owner": None}
+    if type_code != 0 and type_code <= len(building_types):
+        tile["type"] = building_types[type_code - 1]
+    if level != 0:
+        tile["level"] = level
+    if owner_code != 0 and owner_code <= len(player_names):
+        tile["owner"] = player_names[owner_code - 1]
+    return tile
+
+
+def tileToCodes(tile, player_names):
+    building_types = getParams()["building_types"]
+
+    type_code = 0
+    if tile.get("type") != None:
+        type_code = building_types.index(tile["type"]) + 1
+    level = 0
+    if tile.get("level") != None:
+        level = int(tile["level"])
+    owner_code = 0
+    if tile.get("owner") != None:
+        owner_code = player_names.index(tile["owner"]) + 1
+    return type_code, level, owner_code
+
+
+def encodeMap(game_map, player_names):
+    # game_map is the JSON view: a list of rows of {"type", "level", "owner"}
+    map_size = len(game_map)
+    tiles = emptyMap(map_size)
+    for row in range(map_size):
+        for column in range(map_size):
+            setTile(tiles, map_size, row, column, game_map[row][column], player_names)
+    return tiles
+
+
+def decodeMap(tiles, map_size, player_names):
+    cells = map_size * map_size
+    game_map = []
+    for row in range(map_size):
+        columns = []
+        for column in range(map_size):
+            index = tileIndex(map_size, row, column)
+            columns.append(tileToDict(tiles[index], tiles[cells + index], tiles[2 * cells + index], player_names))
+        game_map.append(columns)
+    return game_map
+
+
+def removeOwner(tiles, map_size, owner_code):
+    # The player at owner_code left: their buildings have no owner anymore and
+    # the players after them move down one position. Returns the changed indexes
+    cells = map_size * map_size
+    offset = planeOffset(map_size, OWNER_PLANE)
+    changed = []
+    for index in range(cells):
+        code = tiles[offset + index]
+        if code == owner_code:
+            tiles[offset + index] = 0
+            changed.append(index)
+        elif code > owner_code:
+            tiles[offset + index] = code - 1
+            changed.append(index)
+    return changed
+
+
+def dumpMap(tiles):
+    # Value to store in the map attribute, boto3 writes bytes as Binary
+    with span("map.encode", len(tiles)):
+        return tiles.tobytes()
+
+
+def loadMap(value, map_size, player_names):
+    # Games written before the binary format still hold a JSON string
+    if isinstance(value, str):
+        with span("map.decode_json", len(value)):
+            game_map = json.loads(value)
+            if len(game_map) == 0:
+                return emptyMap(map_size)
+            return encodeMap(game_map, player_names)
+
+    # boto3 reads Binary attributes as boto3.dynamodb.types.Binary
+    with span("map.decode") as current:
+        tiles = array('B')
+        tiles.frombytes(bytes(getattr(value, "value", value)))
+        current.size = len(tiles)
+    if len(tiles) != PLANES * map_size * map_size:
+        raise ValueError("Map does not match map_size")
+    return tiles
+
+
+def emptyTileVersions(map_size, version):
+    # Game version at which each tile last changed, used for delta responses
+    return array('I', [version]) * (map_size * map_size)
+
+
+def dumpTileVersions(versions):
+    # Stored little endian whatever the platform
+    if sys.byteorder != "little":
+        versions = array('I', versions)
+        versions.byteswap()
+    return versions.tobytes()
+
+
+def loadTileVersions(value, map_size):
+    versions = array('I')
+    versions.frombytes(bytes(getattr(value, "value", value)))
+    if sys.byteorder != "little":
+        versions.byteswap()
+    if len(versions) != map_size * map_size:
+        raise ValueError("Tile versions do not match map_size")
+    return versions
+
+
+def changedTiles(tiles, versions, map_size, player_names, since_version):
+    changed = []
+    cells = map_size * map_size
+    for index in range(cells):
+        if versions[index] > since_version:
+            tile = tileToDict(tiles[index], tiles[cells + index], tiles[2 * cells + index], player_names)
+            tile["row"], tile["column"] = divmod(index, map_size)
+            changed.append(tile)
+    return changed
+
+
+def mapView(tiles, map_size, player_names, map_format):
+    # "packed" is the base64 of the stored bytes, "json" the list of tile dicts
+    with span("map.view", len(tiles)):
+        if map_format == "json":
+            return decodeMap(tiles, map_size, player_names)
+        return base64.b64encode(tiles.tobytes()).decode('ascii')
@@ -0,0 +1,13 @@
+import json
+from database import accounted
+from modifyGame import matchQueuedPlayers
+
+
+@accounted("matchmaker")
+def lambda_handler(event, context):
+    # Scheduled: turns the players queued by MATCHMAKE into started games
+    games, queued = matchQueuedPlayers()
+
+    result = {"games": len(games), "queued": queued}
+    print(json.dumps(result))
+    return result
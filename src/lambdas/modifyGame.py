@@ -1,35 +1,92 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Attr
+import botocore
 import uuid
-from datetime import datetime
-from common import checkUser, generateHashedPassword, returnErrorMessage
+import time
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+from database import accounted, archiveDB, client, gameDB, playerDB
+from common import authenticateRequest, claimActiveGame, createUser, isConditionalCheckFailure, releaseActiveGame, notifyGameChanged, returnErrorMessage
 from parameters import getParams
+from mapCodec import emptyMap, dumpMap, loadMap, removeOwner, emptyTileVersions, loadTileVersions, dumpTileVersions
+from gameCache import gameCache
+from idempotency import idempotent
+from journal import deleteJournal, journalRecord, loadGameItem, recordPut
 
-dynamodb = boto3.resource('dynamodb')
-gameDB = dynamodb.Table('gameDB')
-playerDB = dynamodb.Table('playerDB')
 
+# Attempts for join, leave and start when another request changes the game first
+MAX_UPDATE_ATTEMPTS = 3
+CONFLICT_MESSAGE = "Game was modified by another request, try again"
 
-def generateGame(user):
-    #Check if user already in another game
-    response = gameDB.scan(FilterExpression=Attr('player_names').contains(user) & Attr('status').ne("FINISHED"))
-    data = response['Items']
-    if len(data) != 0:
-        return False, "User is already in a game", None
-    
+# Matchmaking: games are filled up to MATCH_SIZE players, smaller ones (down
+# to MIN_MATCH_SIZE) are only made for players waiting MATCHMAKING_MAX_WAIT seconds
+MATCH_SIZE = 4
+MIN_MATCH_SIZE = 2
+MATCHMAKING_MAX_WAIT = 30
+
+# Queued players read by one matchQueuedPlayers run, and games created in parallel
+MATCHMAKING_READ_LIMIT = 1000
+MATCH_WORKERS = 16
+
+
+def newGameItem(game_id, player_names):
     item = {}
-    item["game_id"] = str(uuid.uuid4())
+    item["game_id"] = game_id
     item["status"] = "WAITING"
-    item["players"] = 1
-    item["player_names"] = json.dumps([user])
+    item["lobby"] = "WAITING" # Only set while the game can be joined, see lobby-index
+    item["created_at"] = int(time.time() * 1000)
+    item["players"] = len(player_names)
+    item["player_names"] = json.dumps(player_names)
     item["turn"] = 0
     item["action_done"] = False
-    item["map"] = json.dumps([])
+    item["map"] = dumpMap(emptyMap(0))
     item["year"] = 0
     item["map_size"] = 0
+    item["version"] = 1 # Bumped on every change to the game, see getGameStatus since_version
+    return item
+
+
+def startedGameFields(player_names, version):
+    # Attributes that turn a WAITING game into a PLAYING one at version
+    params = getParams()
+    map_size = params["map_size"][len(player_names)-1]
+
+    # In-game player state lives on the game item, so starting a game is one
+    # conditional write however many players there are
+    player_state = {}
+    for player in player_names:
+        player_state[player] = {
+            "money": params["initial_money"],
+            "debt": 0,
+            "accumulated_points": 0,
+            "version": version,
+        }
 
-    gameDB.put_item(Item=item)
+    return {
+        "status": "PLAYING",
+        "year": params["start_year"],
+        "turn": 1,
+        "map_size": map_size,
+        "map": dumpMap(emptyMap(map_size)),
+        "tile_versions": dumpTileVersions(emptyTileVersions(map_size, version)),
+        "player_state": player_state,
+    }
+
+
+def generateGame(user):
+    game_id = str(uuid.uuid4())
+
+    #Check if user already in another game
+    success, message = claimActiveGame(user, game_id)
+    if not success:
+        return False, message, None
+
+    item = newGameItem(game_id, [user])
+
+    client.transact_write_items(TransactItems=[
+        {"Put": {"TableName": gameDB.name, "Item": item}},
+        recordPut(journalRecord(game_id, item["version"], "CREATE", user)),
+    ])
+    notifyGameChanged(game_id, item["version"])
     return True, "Game generated", item["game_id"]
 
 
@@ -55,23 +112,62 @@ def deleteGame(user, game_id):
             'game_id': game_id
         }
     )
+    deleteJournal(game_id)
+    gameCache.invalidate(game_id)
+    # An archived copy can no longer be looked up
+    archiveDB.delete_item(Key={'game_id': game_id})
+    releaseActiveGame(player_names, game_id)
+    notifyGameChanged(game_id, None)
     return True, "Game deleted"
         
 
-def joinGame(user, game_id):
-    response = gameDB.scan(FilterExpression=Attr('player_names').contains(user) & Attr('status').ne("FINISHED"))
-    data = response['Items']
-    if len(data) != 0:
-        return False, "User is already in a game"
-
-    # Check if game exists
-    response = gameDB.get_item(Key={'game_id': game_id})
-
-    if "Item" not in response: #user exists
-        return False, "game_id does not exist"
+def updateGameIfVersion(game_id, expected_version, update_expression, values, names=None, action="UPDATE", user=None):
+    # Optimistic concurrency: the journal record of the next version is
+    # written with the update and only one request can write it, returns False
+    # on conflict so the caller re-reads. The snapshot may be older than
+    # expected_version (see journal), the update has to carry the whole game then
+    values = dict(values)
+    values[":expected"] = expected_version
+    names = dict(names or {})
+    names["#version"] = "version"
+
+    try:
+        client.transact_write_items(TransactItems=[
+            recordPut(journalRecord(game_id, expected_version + 1, action, user)),
+            {"Update": {
+                "TableName": gameDB.name,
+                "Key": {'game_id': game_id},
+                "UpdateExpression": update_expression,
+                "ConditionExpression": "attribute_exists(game_id) AND (attribute_not_exists(#version) OR #version <= :expected)",
+                "ExpressionAttributeValues": values,
+                "ExpressionAttributeNames": names,
+            }},
+        ])
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        return False
+    return True
+
+
+def deleteGameIfVersion(game_id, expected_version):
+    # The snapshot may be older than the expected_version loaded from the journal
+    try:
+        gameDB.delete_item(
+            Key={'game_id': game_id},
+            ConditionExpression="attribute_not_exists(version) OR version <= :expected",
+            ExpressionAttributeValues={":expected": expected_version},
+        )
+    except botocore.exceptions.ClientError as ex:
+        if not isConditionalCheckFailure(ex):
+            raise
+        return False
+    deleteJournal(game_id)
+    gameCache.invalidate(game_id)
+    return True
 
-    item = response["Item"]
 
+def checkJoinable(user, item):
     # Check if game is waiting
     if "status" not in item:
         return False, "Error in database"
@@ -93,139 +189,382 @@ def joinGame(user, game_id):
     if "player_names" not in item:
         return False, "Error in database"
 
-    player_names = json.loads(item["player_names"])
-    player_names.append(user)
-
-    players = players + 1
+    if user in json.loads(item["player_names"]):
+        return False, "User is already in a game"
 
-    gameDB.update_item(
-        Key={'game_id': game_id},
-        UpdateExpression="SET players = :players, player_names = :pn",
-        ExpressionAttributeValues={":players": players, ":pn": json.dumps(player_names)},
-    )
-  
-    return True, "Game joined"
+    return True, "Ok"
 
 
-def startGame(user, game_id):
-    # Check if game exists
-    response = gameDB.get_item(Key={'game_id': game_id})
+def joinGame(user, game_id):
+    claimed = False
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        # Check if game exists
+        response = gameDB.get_item(Key={'game_id': game_id})
 
-    if "Item" not in response: #user exists
-        return False, "game_id does not exist"
+        if "Item" not in response: #user exists
+            message = "game_id does not exist"
+            break
 
-    item = response["Item"]
+        item = response["Item"]
 
-    if "player_names" not in item:
-        return False, "Error in database"
+        success, message = checkJoinable(user, item)
+        if not success:
+            break
 
-    player_names = json.loads(item["player_names"])
+        #Check if user already in another game
+        if not claimed:
+            success, message = claimActiveGame(user, game_id)
+            if not success:
+                return False, message
+            claimed = True
 
-    if player_names[0] != user:
-        return False, "Only game owner can start the game"
+        player_names = json.loads(item["player_names"])
+        player_names.append(user)
 
-    if "status" not in item:
-        return False, "Error in database"
-    status = item["status"]
+        players = item["players"] + 1
+        current_version = int(item.get("version", 0))
+        version = current_version + 1
 
-    if status != "WAITING":
-        return False, "Game already started"
+        update_expression = "SET players = :players, player_names = :pn, #version = :v"
+        if players >= 4:
+            update_expression += " REMOVE lobby"
 
+        if updateGameIfVersion(game_id, current_version, update_expression,
+                               {":players": players, ":pn": json.dumps(player_names), ":v": version},
+                               action="JOIN", user=user):
+            notifyGameChanged(game_id, version)
+            return True, "Game joined"
+        message = CONFLICT_MESSAGE
 
-    params = getParams()
-    
-    status = "PLAYING"
-    year = params["start_year"]
-    turn = 1
-    map_size = params["map_size"][int(item["players"])-1]
-    game_map = []
-
-    empty = {
-                "type": None,
-                "level": None,
-                "owner": None
-            }
-    for rows in range(map_size):
-        column = []
-        for columns in range(map_size):
-            column.append(empty)
-        game_map.append(column)
-
-    gameDB.update_item(
-            Key={'game_id': game_id},
-            UpdateExpression="SET #s = :s, #y = :y, #t = :t, #ms = :ms, #m = :m",
-            ExpressionAttributeValues={
-                ":s": status,
-                ":y": year,
-                ":t": turn,
-                ":ms": map_size,
-                ":m": json.dumps(game_map)},
-            ExpressionAttributeNames={
-                "#s": "status",
-                "#y": "year",
-                "#t": "turn",
-                "#ms": "map_size",
-                "#m": "map",
-            }
-        )
+    # Do not leave the player pointing to a game they did not join
+    if claimed:
+        releaseActiveGame(user, game_id)
+    return False, message
 
-    for player in player_names:
-        playerDB.update_item(
-                Key={'player_id': player},
-                UpdateExpression="SET #m = :m, #d = :d, #p = :p",
-                ExpressionAttributeValues={
-                    ":m": params["initial_money"],
-                    ":d": 0,
-                    ":p": 0},
-                ExpressionAttributeNames={
-                    "#m": "money",
-                    "#d": "debt",
-                    "#p": "accumulated_points",
-                }
-            )
 
-    return True, "Game started"
+def startGame(user, game_id):
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        # Check if game exists
+        response = gameDB.get_item(Key={'game_id': game_id})
+
+        if "Item" not in response: #user exists
+            return False, "game_id does not exist"
+
+        item = response["Item"]
+
+        if "player_names" not in item:
+            return False, "Error in database"
+
+        player_names = json.loads(item["player_names"])
+
+        if player_names[0] != user:
+            return False, "Only game owner can start the game"
+
+        if "status" not in item:
+            return False, "Error in database"
+        status = item["status"]
+
+        if status != "WAITING":
+            return False, "Game already started"
+
+
+        current_version = int(item.get("version", 0))
+        version = current_version + 1
+        fields = startedGameFields(player_names, version)
+
+        if updateGameIfVersion(
+                game_id,
+                current_version,
+                "SET #s = :s, #y = :y, #t = :t, #ms = :ms, #m = :m, #tv = :tv, #ps = :ps, #version = :v REMOVE lobby",
+                {
+                    ":s": fields["status"],
+                    ":y": fields["year"],
+                    ":t": fields["turn"],
+                    ":ms": fields["map_size"],
+                    ":m": fields["map"],
+                    ":tv": fields["tile_versions"],
+                    ":ps": fields["player_state"],
+                    ":v": version},
+                {
+                    "#s": "status",
+                    "#y": "year",
+                    "#t": "turn",
+                    "#ms": "map_size",
+                    "#m": "map",
+                    "#tv": "tile_versions",
+                    "#ps": "player_state",
+                },
+                action="START",
+                user=user):
+            notifyGameChanged(game_id, version)
+            return True, "Game started"
+
+    return False, CONFLICT_MESSAGE
 
 
         
 def leaveGame(user, game_id):
-    # Check if game exists
-    response = gameDB.get_item(Key={'game_id': game_id})
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        # Check if game exists, a game being played may have plays after its snapshot
+        item = loadGameItem(game_id)
 
-    if "Item" not in response: #user exists
-        return False, "game_id does not exist"
+        if item == None:
+            return False, "game_id does not exist"
 
-    item = response["Item"]
 
+        if "player_names" not in item:
+            return False, "Error in database"
 
-    if "player_names" not in item:
-        return False, "Error in database"
+        player_names = json.loads(item["player_names"])
 
-    player_names = json.loads(item["player_names"])
+        if user not in player_names:
+            return False, "User is not in this game"
 
-    if user not in player_names:
-        return False, "User is not in this game"
-    player_names.remove(user)
+        # A finished game is kept as it ended, archived with its journal
+        if item.get("status") == "FINISHED":
+            return False, "Game is already finished"
 
-    players = len(player_names)
+        position = player_names.index(user) + 1
+        player_names.remove(user)
 
-    if players == 0:
-        gameDB.delete_item(
-            Key={
-                'game_id': game_id
-            }
-        )
-    else:
-        gameDB.update_item(
-            Key={'game_id': game_id},
-            UpdateExpression="SET players = :players, player_names = :pn",
-            ExpressionAttributeValues={":players": players, ":pn": json.dumps(player_names)},
-        )
+        players = len(player_names)
+        current_version = int(item.get("version", 0))
+        version = current_version + 1
 
-    return True, "Game left"
-    
+        if players == 0:
+            version = None
+            updated = deleteGameIfVersion(game_id, current_version)
+        elif item.get("status") == "WAITING":
+            # A seat is free again, put the game back in the lobby
+            updated = updateGameIfVersion(
+                game_id,
+                current_version,
+                "SET players = :players, player_names = :pn, #version = :v, lobby = :l",
+                {":players": players, ":pn": json.dumps(player_names), ":v": version, ":l": "WAITING"},
+                action="LEAVE",
+                user=user,
+            )
+        else:
+            # Written as a new snapshot with the plays of the journal in it.
+            # Owner codes and turn are positions in player_names, the ones
+            # after the player who left move down with the names
+            map_size = int(item["map_size"])
+            tiles = loadMap(item["map"], map_size, json.loads(item["player_names"]))
+            if "tile_versions" in item:
+                tile_versions = loadTileVersions(item["tile_versions"], map_size)
+            else:
+                tile_versions = emptyTileVersions(map_size, current_version)
+            for index in removeOwner(tiles, map_size, position):
+                tile_versions[index] = version
+
+            player_state = dict(item.get("player_state", {}))
+            player_state.pop(user, None)
+
+            turn = int(item["turn"])
+            action_done = item.get("action_done", False)
+            if turn > position:
+                turn -= 1
+            elif turn == position:
+                # It was their turn, the next player starts theirs
+                action_done = False
+
+            update_expression = ("SET players = :players, player_names = :pn, #version = :v, turn = :t, action_done = :ad, "
+                                 "#y = :y, #m = :m, tile_versions = :tv, player_state = :ps")
+            values = {":players": players, ":pn": json.dumps(player_names), ":v": version, ":t": turn,
+                      ":ad": action_done, ":y": item["year"], ":m": dumpMap(tiles),
+                      ":tv": dumpTileVersions(tile_versions), ":ps": player_state}
+            if turn > players:
+                # Everyone left has passed, endOfTurn ends the year (see play.saveGameState)
+                update_expression += ", year_end = :ye"
+                values[":ye"] = "PENDING"
+            updated = updateGameIfVersion(
+                game_id,
+                current_version,
+                update_expression,
+                values,
+                {"#y": "year", "#m": "map"},
+                action="LEAVE",
+                user=user,
+            )
+
+        if updated:
+            releaseActiveGame(user, game_id)
+            notifyGameChanged(game_id, version)
+            return True, "Game left"
+
+    return False, CONFLICT_MESSAGE
+
+
+def queueForMatch(user):
+    # Returns success, message and the game of the player once it was matched
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        response = playerDB.get_item(Key={'player_id': user}, ProjectionExpression="active_game")
+        current = response.get("Item", {}).get("active_game")
+        if current != None:
+            response = gameDB.get_item(
+                Key={'game_id': current},
+                ProjectionExpression="#s, matched",
+                ExpressionAttributeNames={"#s": "status"},
+            )
+            game = response.get("Item")
+            if game != None and game.get("status") != "FINISHED":
+                if game.get("matched", False):
+                    return True, "Match found", current
+                return False, "User is already in a game", None
+
+        # Queued again keeps the original place in the queue, a slot left by a
+        # finished or deleted game is given up
+        values = {":q": "QUEUED", ":now": int(time.time() * 1000)}
+        update_expression = "SET matchmaking = :q, queued_at = if_not_exists(queued_at, :now)"
+        if current == None:
+            condition = "attribute_not_exists(active_game)"
+        else:
+            update_expression += " REMOVE active_game"
+            condition = "active_game = :old"
+            values[":old"] = current
+
+        try:
+            playerDB.update_item(
+                Key={'player_id': user},
+                UpdateExpression=update_expression,
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values,
+            )
+        except botocore.exceptions.ClientError as ex:
+            if not isConditionalCheckFailure(ex):
+                raise
+            # Matched or joined a game in between, look again
+            continue
 
+        game_id = matchQueuedPlayer(user, values[":now"])
+        if game_id != None:
+            return True, "Match found", game_id
+        return True, "Queued", None
 
+    return False, CONFLICT_MESSAGE, None
+
+
+def leaveMatchQueue(user):
+    try:
+        playerDB.update_item(
+            Key={'player_id': user},
+            UpdateExpression="REMOVE matchmaking, queued_at",
+            ConditionExpression="matchmaking = :q",
+            ExpressionAttributeValues={":q": "QUEUED"},
+        )
+    except botocore.exceptions.ClientError as ex:
+        if not isConditionalCheckFailure(ex):
+            raise
+        return False, "User is not queued"
+    return True, "Left the queue"
+
+
+def findQueuedPlayers(limit):
+    # Oldest first, from the sparse matchmaking-index: only queued players carry matchmaking
+    players = []
+    query = {
+        "IndexName": "matchmaking-index",
+        "KeyConditionExpression": Key('matchmaking').eq('QUEUED'),
+        "Limit": limit,
+    }
+    while len(players) < limit:
+        response = playerDB.query(**query)
+        players.extend({"player_id": item["player_id"], "queued_at": int(item["queued_at"])}
+                       for item in response["Items"])
+        if "LastEvaluatedKey" not in response:
+            break
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return players[:limit]
+
+
+def createMatchedGame(group):
+    # One transaction takes every player out of the queue and writes the game
+    # ready to play, it fails as a whole if any of them is no longer queued.
+    # Returns the game_id (None if it failed) and the players that were not queued
+    game_id = str(uuid.uuid4())
+    player_names = [player["player_id"] for player in group]
+
+    item = newGameItem(game_id, player_names)
+    del item["lobby"]
+    item.update(startedGameFields(player_names, item["version"]))
+    item["matched"] = True
+
+    transaction = []
+    for name in player_names:
+        transaction.append({"Update": {
+            "TableName": playerDB.name,
+            "Key": {'player_id': name},
+            "UpdateExpression": "SET active_game = :g REMOVE matchmaking, queued_at",
+            "ConditionExpression": "matchmaking = :q AND attribute_not_exists(active_game)",
+            "ExpressionAttributeValues": {":g": game_id, ":q": "QUEUED"},
+        }})
+    transaction.append({"Put": {
+        "TableName": gameDB.name,
+        "Item": item,
+        "ConditionExpression": "attribute_not_exists(game_id)",
+    }})
+    transaction.append(recordPut(journalRecord(game_id, item["version"], "MATCHMAKE")))
+
+    try:
+        client.transact_write_items(TransactItems=transaction)
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        reasons = ex.response.get("CancellationReasons", [])
+        gone = set(name for name, reason in zip(player_names, reasons)
+                   if reason.get("Code") == "ConditionalCheckFailed")
+        return None, gone
+
+    notifyGameChanged(game_id, item["version"])
+    return game_id, set()
+
+
+def matchQueuedPlayer(user, queued_at):
+    # Matches a player who just queued with the oldest waiting ones as soon as
+    # a game is full, anything smaller is left to matchQueuedPlayers
+    others = [player for player in findQueuedPlayers(MATCH_SIZE * 2) if player["player_id"] != user]
+    if len(others) < MATCH_SIZE - 1:
+        return None
+    group = [{"player_id": user, "queued_at": queued_at}] + others[:MATCH_SIZE - 1]
+    game_id, _ = createMatchedGame(group)
+    return game_id
+
+
+def groupQueuedPlayers(queued, now):
+    # Full games in queue order, the rest forms a smaller game once its oldest
+    # player has waited MATCHMAKING_MAX_WAIT
+    groups = []
+    while len(queued) >= MATCH_SIZE:
+        groups.append(queued[:MATCH_SIZE])
+        queued = queued[MATCH_SIZE:]
+    if len(queued) >= MIN_MATCH_SIZE and now - queued[0]["queued_at"] >= MATCHMAKING_MAX_WAIT * 1000:
+        groups.append(queued)
+        queued = []
+    return groups, queued
+
+
+def matchQueuedPlayers():
+    # Returns the games created and the players left in the queue
+    queued = findQueuedPlayers(MATCHMAKING_READ_LIMIT)
+    games = []
+    with ThreadPoolExecutor(max_workers=MATCH_WORKERS) as executor:
+        for attempt in range(MAX_UPDATE_ATTEMPTS):
+            groups, queued = groupQueuedPlayers(queued, int(time.time() * 1000))
+            if len(groups) == 0:
+                break
+
+            # Players of a failed group that are still queued are grouped again
+            for group, (game_id, gone) in zip(groups, executor.map(createMatchedGame, groups)):
+                if game_id != None:
+                    games.append(game_id)
+                else:
+                    queued.extend(player for player in group if player["player_id"] not in gone)
+            queued.sort(key=lambda player: player["queued_at"])
+    return games, len(queued)
+
+
+@accounted("modifyGame")
+@idempotent("modifyGame")
 def lambda_handler(event, context):
     
     if "queryStringParameters" in event:
@@ -238,38 +577,12 @@ def lambda_handler(event, context):
     else:
         return returnErrorMessage("Action is missing in request")
 
-    if params != None and "user" in params:
-        user = params["user"]
-        if user == "":
-            return returnErrorMessage("User can't be empty")
-    else:
-        return returnErrorMessage("User is missing in request")
-
-    if params != None and "password" in params:
-        password = params["password"]
-        if password == "":
-            return returnErrorMessage("Password can't be empty")
-    else:
-        return returnErrorMessage("Password is missing in request")
-
-
 
-    success, message = checkUser(user, password)
+    success, message, user = authenticateRequest(params)
 
     if not success:
         if message == "User does not exist":
-            salt, key = generateHashedPassword(password)
-
-            item = {}
-            item["player_id"] = user
-            item["hashed_pass"] = key.hex()
-            item["salt"] = salt.hex()
-            item["last_connection"] = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-            item["money"] = 0
-            item["debt"] = 0
-            item["accumulated_points"] = 0
-
-            playerDB.put_item(Item=item)
+            createUser(user, params["password"])
         else:
             return returnErrorMessage(message)
 
@@ -311,6 +624,15 @@ def lambda_handler(event, context):
         success, message = startGame(user, game_id)
         answer = {}
         answer["message"] = message
+    elif action == "MATCHMAKE":
+        success, message, game_id = queueForMatch(user)
+        answer = {}
+        answer["message"] = message
+        answer["game_id"] = game_id
+    elif action == "CANCEL_MATCHMAKE":
+        success, message = leaveMatchQueue(user)
+        answer = {}
+        answer["message"] = message
     else:
         return returnErrorMessage("Unkown action")
 
@@ -5,6 +5,12 @@ params = {
     "start_year" : 1983,
     "finish_year" : 2008,
     "map_size" : [6, 7, 8, 9],
+    "building_types" : ["HOUSE", "APARTMENT", "OFFICE", "SHOP"],
+    "building_cost" : {"HOUSE": 100, "APARTMENT": 250, "OFFICE": 400, "SHOP": 200},
+    "building_income" : {"HOUSE": 10, "APARTMENT": 30, "OFFICE": 50, "SHOP": 25},
+    "max_level" : 5,
+    "destroy_refund" : 0.5,
+    "max_debt" : 10000,
 }
 
 def getParams():
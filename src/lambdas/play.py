@@ -1,90 +1,210 @@
 import json
-import boto3
-from common import checkUser, returnErrorMessage, checkAndExtractFromRequest
-from parameters import getParams
+import botocore
+from database import accounted, client, gameDB
+from common import authenticateRequest, returnErrorMessage, checkAndExtractFromRequest, isConditionalCheckFailure, notifyGameChanged
+from mapCodec import dumpMap, dumpTileVersions
+from gameCache import gameCache
+from idempotency import idempotent
+from leaderboard import pointsUpdates, rankedTotals
+from journal import loadGameItem, needsSnapshot, playingCheck, playRecord, recordPut
 
-dynamodb = boto3.resource('dynamodb')
-gameDB = dynamodb.Table('gameDB')
-playerDB = dynamodb.Table('playerDB')
 
+# Attempts when another request changes the game between load and save
+MAX_PLAY_ATTEMPTS = 3
 
-def passTurn(game, player_info):
-    pass
 
-def destroy(game, player_info, coordinates):
-    pass
+def loadGameState(user, game_id, cached=None):
+    # Players' in-game state is on the game item, the snapshot and its journal
+    # tail load everything. A game kept by this container (gameCache) is used
+    # without reading, the conditional save is what tells if it was still current
+    if cached == None:
+        item = loadGameItem(game_id)
 
-def upgrade(game, player_info, coordinates, level):
-    pass
+        if item == None:
+            gameCache.invalidate(game_id)
+            return False, "game_id does not exist", None
 
-def build(game, player_info, coordinates, type, level):
-    pass
+        cached = gameCache.put(item)
 
-def askLoan(game, player_info, amount):
-    pass
+    if user not in cached.player_names:
+        return False, "User is not in game", None
 
-def payLoan(game, player_info, amount):
-    pass
+    if cached.item["status"] != "PLAYING":
+        return False, "Game is not being played", None
 
-def play(game, player_info, action, params):
+    return True, "Ok", cached.toGameState()
+
+
+def saveGameState(state, loaded_version, action="UPDATE", user=None, params=None):
+    # Appends the journal record of the new version, it fails if another
+    # request saved the game since it was loaded. The snapshot in gameDB is
+    # only rewritten when journal.needsSnapshot says so
+    updates = {
+        "turn": state.turn,
+        "action_done": state.action_done,
+        "year": state.year,
+        "status": state.status,
+        "version": state.nextVersion(),
+    }
+    if len(state.changed_tiles) != 0:
+        updates["map"] = dumpMap(state.tiles)
+        updates["tile_versions"] = dumpTileVersions(state.tile_versions)
+    if len(state.changed_players) != 0:
+        updates["player_state"] = state.dumpPlayerState()
+
+    # Sparse attribute read by endOfTurn through year-end-index
+    removed = []
+    if state.isYearOver():
+        updates["year_end"] = "PENDING"
+    else:
+        removed.append("year_end")
+
+    # Sparse attribute read by the archiver through archive-index
+    if state.status == "FINISHED":
+        updates["archive"] = "PENDING"
+
+    record = playRecord(state, action, user, params, removed)
+
+    try:
+        if not needsSnapshot(state):
+            client.transact_write_items(TransactItems=[recordPut(record), playingCheck(state.game_id)])
+        else:
+            transaction = [recordPut(record), {"Update": snapshotUpdate(state, updates, removed)}]
+            # The points of the year reach the leaderboard in the same write
+            # as the game, so they are added once and only if the game is saved
+            if len(state.gained_points) != 0:
+                totals = rankedTotals(list(state.gained_points))
+                transaction.extend(pointsUpdates(state.gained_points, totals))
+            client.transact_write_items(TransactItems=transaction)
+    except botocore.exceptions.ClientError as ex:
+        if not isConditionalCheckFailure(ex) and ex.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        gameCache.invalidate(state.game_id)
+        return False
+
+    # The cached copy moves to the saved version, the next play needs no read
+    gameCache.update(state.game_id, loaded_version, updates, removed)
+    return True
+
+
+def snapshotUpdate(state, updates, removed):
+    # The whole game written to gameDB, the record written with it is what
+    # keeps two requests from saving the same version
+    updates = dict(updates)
+    updates["map"] = dumpMap(state.tiles)
+    updates["tile_versions"] = dumpTileVersions(state.tile_versions)
+    updates["player_state"] = state.players
+
+    game_names = {}
+    game_values = {}
+    assignments = []
+    for number, name in enumerate(updates):
+        game_names["#a" + str(number)] = name
+        game_values[":a" + str(number)] = updates[name]
+        assignments.append("#a{0} = :a{0}".format(number))
+    game_update = "SET " + ", ".join(assignments)
+    for number, name in enumerate(removed):
+        game_names["#r" + str(number)] = name
+    if len(removed) != 0:
+        game_update += " REMOVE " + ", ".join("#r" + str(number) for number in range(len(removed)))
+
+    # Snapshots only move forward, the game must not have been deleted
+    game_names["#v"] = "version"
+    game_values[":next"] = state.nextVersion()
+    return {
+        "TableName": gameDB.name,
+        "Key": {'game_id': state.game_id},
+        "UpdateExpression": game_update,
+        "ConditionExpression": "attribute_exists(game_id) AND (attribute_not_exists(#v) OR #v < :next)",
+        "ExpressionAttributeValues": game_values,
+        "ExpressionAttributeNames": game_names,
+    }
+
+
+def parseCoordinates(coordinates):
+    # "row,column"
+    parts = str(coordinates).split(",")
+    if len(parts) != 2 or not parts[0].strip().isdigit() or not parts[1].strip().isdigit():
+        return None
+    return int(parts[0]), int(parts[1])
+
+
+def parseNumber(value):
+    value = str(value)
+    if not value.isdigit():
+        return None
+    return int(value)
+
+
+def play(state, user, action, params):
 
     if action == "PASS":
-        return passTurn(game, player_info)
+        return state.passTurn(user)
 
-    elif action == "ASK_LOAD":
+    elif action == "ASK_LOAN" or action == "ASK_LOAD":
         success, result = checkAndExtractFromRequest("amount", params)
         if not success:
             return False, result
-        return askLoan(game, player_info, result)
+        amount = parseNumber(result)
+        if amount == None:
+            return False, "amount must be a number"
+        return state.askLoan(user, amount)
 
     elif action == "PAY_LOAN":
-        success, message = checkAndExtractFromRequest("amount", params)
+        success, result = checkAndExtractFromRequest("amount", params)
         if not success:
             return False, result
-        return payLoan(game, player_info, result)
+        amount = parseNumber(result)
+        if amount == None:
+            return False, "amount must be a number"
+        return state.payLoan(user, amount)
 
     elif action == "DESTROY":
-        success, message = checkAndExtractFromRequest("coordinates", params)
+        success, result = checkAndExtractFromRequest("coordinates", params)
         if not success:
             return False, result
-        return destroy(game, player_info, result)
-    
+        coordinates = parseCoordinates(result)
+        if coordinates == None:
+            return False, "coordinates must be row,column"
+        return state.destroy(user, coordinates[0], coordinates[1])
+
     elif action == "UPGRADE":
-        success, message = checkAndExtractFromRequest(["coordinates", "level"], params)
+        success, result = checkAndExtractFromRequest(["coordinates", "level"], params)
         if not success:
             return False, result
-        return destroy(game, player_info, result[0], result[1])
-    
+        coordinates = parseCoordinates(result[0])
+        if coordinates == None:
+            return False, "coordinates must be row,column"
+        level = parseNumber(result[1])
+        if level == None:
+            return False, "level must be a number"
+        return state.upgrade(user, coordinates[0], coordinates[1], level)
+
     elif action == "BUILD":
-        success, message = checkAndExtractFromRequest(["coordinates", "type", "level"], params)
+        success, result = checkAndExtractFromRequest(["coordinates", "type", "level"], params)
         if not success:
             return False, result
-        return destroy(game, player_info, result[0], result[1], result[2])
+        coordinates = parseCoordinates(result[0])
+        if coordinates == None:
+            return False, "coordinates must be row,column"
+        level = parseNumber(result[2])
+        if level == None:
+            return False, "level must be a number"
+        return state.build(user, coordinates[0], coordinates[1], result[1], level)
     else:
-        return False, "Amount is missing in request"
+        return False, "Unknown action"
+
 
-            
 
+@accounted("play")
+@idempotent("play")
 def lambda_handler(event, context):
-    
+
     if "queryStringParameters" in event:
         params = event["queryStringParameters"]
     else:
         return returnErrorMessage("No params")
 
-    if params != None and "user" in params:
-        user = params["user"]
-        if user == "":
-            return returnErrorMessage("User can't be empty")
-    else:
-        return returnErrorMessage("User is missing in request")
-
-    if params != None and "password" in params:
-        password = params["password"]
-        if password == "":
-            return returnErrorMessage("Password can't be empty")
-    else:
-        return returnErrorMessage("Password is missing in request")
 
     if params != None and "game_id" in params:
         game_id = params["game_id"]
@@ -96,38 +216,42 @@ def lambda_handler(event, context):
     else:
         return returnErrorMessage("Action is missing in request")
 
-    success, message = checkUser(user, password)
+    success, message, user = authenticateRequest(params)
 
     if not success:
         return returnErrorMessage(message)
 
-    response = gameDB.get_item(Key={'game_id': game_id})
+    # One load (none if this container has the game cached), the move applied
+    # in memory, one conditional save
+    cached = gameCache.get(game_id)
+    for attempt in range(MAX_PLAY_ATTEMPTS):
+        success, message, state = loadGameState(user, game_id, cached)
+        if success:
+            loaded_version = state.version
+            success, message = play(state, user, action, params)
 
-    if "Item" not in response:
-        return returnErrorMessage("game_id does not exist")
+        if not success:
+            # The cached copy may be stale, a refusal only counts on a fresh read
+            if cached != None:
+                gameCache.invalidate(game_id)
+                cached = None
+                continue
+            return returnErrorMessage(message)
 
-    game = response["Item"]
-    if user not in json.loads(game["player_names"]):
-        return returnErrorMessage("User is not in game")
+        if saveGameState(state, loaded_version, action, user, params):
+            break
+        cached = None
+    else:
+        return returnErrorMessage("Game was modified by another request, try again")
 
-    response = playerDB.get_item(Key={'player_id': user})
-    if "Item" not in response:
-        return returnErrorMessage("player_id does not exist")
-    
-    player_info = response["Item"]
-    
-    success, message = play(game, player_info, action, params)
+    notifyGameChanged(game_id, state.nextVersion())
 
-    if not success:
-        return returnErrorMessage(message)
-    
-    answer = {"message": message, "status": status}
+    answer = {"message": message, "version": state.nextVersion()}
 
     responseObject = {}
     responseObject['statusCode'] = 200
     responseObject['headers'] = {}
-    responseObject['headers']['Content-Type'] = 'application/json'  
+    responseObject['headers']['Content-Type'] = 'application/json'
     responseObject['body'] = json.dumps(answer)
 
     return responseObject
-
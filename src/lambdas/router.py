@@ -0,0 +1,79 @@
+import importlib
+import json
+
+
+# API path -> module whose lambda_handler serves it, the same handlers are
+# also deployed one per function (see UseRouter in deploy/template.yml)
+ROUTES = {
+    "/availableGames": "listAvailableGames",
+    "/modifyGame": "modifyGame",
+    "/getGameStatus": "getGameStatus",
+    "/login": "login",
+    "/waitForUpdate": "waitForUpdate",
+    "/play": "play",
+    "/leaderboard": "leaderboard",
+    "/archive": "archive",
+}
+
+# Requests without a known path are sent by their action
+ACTIONS = {
+    "CREATE": "modifyGame",
+    "DELETE": "modifyGame",
+    "JOIN": "modifyGame",
+    "LEAVE": "modifyGame",
+    "START": "modifyGame",
+    "MATCHMAKE": "modifyGame",
+    "CANCEL_MATCHMAKE": "modifyGame",
+    "PASS": "play",
+    "BUILD": "play",
+    "UPGRADE": "play",
+    "DESTROY": "play",
+    "ASK_LOAN": "play",
+    "ASK_LOAD": "play",
+    "PAY_LOAN": "play",
+}
+
+# Module run by the scheduled rule
+SCHEDULED_MODULE = "endOfTurn"
+
+# Handler modules are imported the first time they are needed and then kept,
+# so a cold container only pays for the endpoint it was started for
+handlers = {}
+
+
+def getHandler(module_name):
+    if module_name not in handlers:
+        handlers[module_name] = importlib.import_module(module_name).lambda_handler
+    return handlers[module_name]
+
+
+def findModule(event):
+    # The scheduled rule of endOfTurn sends an EventBridge event, not a request
+    if event.get("source") == "aws.events":
+        return SCHEDULED_MODULE
+
+    # resource is the path as declared in the API, path can carry a base path mapping
+    for field in ["resource", "path"]:
+        path = event.get(field)
+        if path == None:
+            continue
+        path = "/" + path.rstrip("/").split("/")[-1]
+        if path in ROUTES:
+            return ROUTES[path]
+
+    params = event.get("queryStringParameters") or {}
+    return ACTIONS.get(params.get("action"))
+
+
+def lambda_handler(event, context):
+    module_name = findModule(event)
+
+    if module_name == None:
+        responseObject = {}
+        responseObject['statusCode'] = 404
+        responseObject['headers'] = {}
+        responseObject['headers']['Content-Type'] = 'application/json'
+        responseObject['body'] = json.dumps("Unknown path")
+        return responseObject
+
+    return getHandler(module_name)(event, context)
@@ -0,0 +1,124 @@
+import json
+import os
+import random
+import threading
+import time
+
+
+def getSampleRate():
+    # TRACE_SAMPLE_RATE: share of requests that print their trace line, 0 to 1
+    try:
+        return min(max(float(os.environ.get("TRACE_SAMPLE_RATE", "1")), 0.0), 1.0)
+    except ValueError:
+        return 1.0
+
+
+class Trace:
+    # Spans of one handler invocation, added up by name
+
+    def __init__(self, handler, sampled):
+        self.lock = threading.Lock()
+        self.handler = handler
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.fields = {}
+
+    def record(self, name, elapsed, size=0):
+        with self.lock:
+            span = self.spans.get(name)
+            if span == None:
+                span = self.spans[name] = {"count": 0, "ms": 0.0, "bytes": 0}
+            span["count"] += 1
+            span["ms"] += elapsed * 1000
+            span["bytes"] += size
+
+    def summary(self):
+        with self.lock:
+            spans = {}
+            for name, span in self.spans.items():
+                spans[name] = {"count": span["count"], "ms": round(span["ms"], 3), "bytes": span["bytes"]}
+            summary = {
+                "handler": self.handler,
+                "ms": round((time.perf_counter() - self.started) * 1000, 3),
+                "sample_rate": getSampleRate(),
+                "spans": spans,
+            }
+            summary.update(self.fields)
+            return summary
+
+
+class Span:
+    # with span("name") as current: ... current.size = bytes handled
+
+    __slots__ = ["trace", "name", "size", "started"]
+
+    def __init__(self, trace, name, size):
+        self.trace = trace
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.record(self.name, time.perf_counter() - self.started, self.size)
+        return False
+
+
+class NoSpan:
+    # Stands in for Span outside a sampled request, nothing is measured
+
+    @property
+    def size(self):
+        return 0
+
+    @size.setter
+    def size(self, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+# Trace of the invocation being handled, a container handles one at a time
+current = None
+
+
+def startTrace(handler):
+    global current
+    current = Trace(handler, random.random() < getSampleRate())
+    return current
+
+
+def finishTrace(trace, **fields):
+    # Prints the trace line of a sampled invocation, fields are added to it
+    global current
+    if current is trace:
+        current = None
+    if not trace.sampled:
+        return None
+    trace.fields.update(fields)
+    summary = trace.summary()
+    print(json.dumps(summary))
+    return summary
+
+
+def span(name, size=0):
+    trace = current
+    if trace == None or not trace.sampled:
+        return NO_SPAN
+    return Span(trace, name, size)
+
+
+def record(name, elapsed, size=0):
+    # For spans measured elsewhere, e.g. the DynamoDB event hooks
+    trace = current
+    if trace != None and trace.sampled:
+        trace.record(name, elapsed, size)
@@ -0,0 +1,105 @@
+import json
+import time
+from database import accounted
+from common import authenticateRequest, returnErrorMessage, compressResponse
+from getGameStatus import buildGameStatus, checkGameVersion
+from journal import lastVersion
+from tracing import span
+
+# API Gateway gives up after 29 seconds
+DEFAULT_TIMEOUT = 20
+MAX_TIMEOUT = 25
+
+# Delay between version checks grows from the first to the last value. On
+# Lambda nothing notifies a waiting request (see common.notifyGameChanged),
+# every check is a read billed with the whole hold
+POLL_INTERVALS = [0.5, 1.0, 2.0]
+
+
+def waitForGameChange(user, game_id, since_version, timeout):
+    # Holds the request until the game version moves past since_version. The
+    # user is checked to be in the game once, then every check is one read of
+    # the last journal record (a Query of one key, Limit 1)
+    deadline = time.time() + timeout
+    success, message, version = checkGameVersion(user, game_id)
+    if not success:
+        return False, message, None
+    checks = 0
+    while True:
+        if version != since_version:
+            return True, "Changed", version
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return True, "Timeout", version
+
+        time.sleep(min(POLL_INTERVALS[min(checks, len(POLL_INTERVALS) - 1)], remaining))
+        checks += 1
+
+        # A deleted game has no journal left, games older than the journal
+        # never had one: both are read like the first time
+        version = lastVersion(game_id)
+        if version == None:
+            success, message, version = checkGameVersion(user, game_id)
+            if not success:
+                return False, message, None
+
+
+@accounted("waitForUpdate")
+def lambda_handler(event, context):
+
+    if "queryStringParameters" in event:
+        params = event["queryStringParameters"]
+    else:
+        return returnErrorMessage("No params")
+
+    if params != None and "game_id" in params:
+        game_id = params["game_id"]
+    else:
+        return returnErrorMessage("Game_id is missing in request")
+
+    if "since_version" in params and params["since_version"].isdigit():
+        since_version = int(params["since_version"])
+    else:
+        return returnErrorMessage("since_version is missing in request")
+
+    timeout = DEFAULT_TIMEOUT
+    if "timeout" in params:
+        if not params["timeout"].isdigit():
+            return returnErrorMessage("timeout must be a number")
+        timeout = min(int(params["timeout"]), MAX_TIMEOUT)
+
+    map_format = "packed"
+    if "map_format" in params:
+        map_format = params["map_format"]
+        if map_format not in ["packed", "json"]:
+            return returnErrorMessage("map_format must be packed or json")
+
+    success, message, user = authenticateRequest(params)
+
+    if not success:
+        return returnErrorMessage(message)
+
+    success, message, version = waitForGameChange(user, game_id, since_version, timeout)
+
+    if not success:
+        return returnErrorMessage(message)
+
+    if message == "Timeout":
+        answer = {"message": "Unchanged", "status": {"unchanged": True, "version": version}}
+    else:
+        # The version was just read, buildGameStatus does not read it again
+        success, message, status = buildGameStatus(user, game_id, map_format, since_version, version)
+        if not success:
+            return returnErrorMessage(message)
+        answer = {"message": message, "status": status}
+
+    responseObject = {}
+    responseObject['statusCode'] = 200
+    responseObject['headers'] = {}
+    responseObject['headers']['Content-Type'] = 'application/json'
+    with span("response.encode") as current:
+        responseObject['body'] = json.dumps(answer)
+        current.size = len(responseObject['body'])
+
+    return compressResponse(event, responseObject)
@@ -0,0 +1,248 @@
+"""Micro-benchmarks of the hot paths, offline against localDynamo.
+
+    python tools/benchmark.py --save      # run and store the results as baseline
+    python tools/benchmark.py             # run and compare with the baseline
+    python tools/benchmark.py --filter status --runs 200
+
+Every benchmark reports the min, median and p95 latency of one call, the bytes
+allocated by one call (tracemalloc peak) and the DynamoDB calls it makes.
+Compared with the baseline, a run fails (exit code 1) when a benchmark got
+slower than --latency-threshold, allocates more than --memory-threshold
+more, or makes any extra DynamoDB call. The latency check uses the min of
+the runs, the least disturbed by the rest of the machine. Latency depends
+on the machine, so compare with baselines saved on the same one.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from localDynamo import startLocalDynamo
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarkBaseline.json")
+
+# Latency changes smaller than this (ms) are noise whatever the ratio
+LATENCY_SLACK = 0.05
+
+PASSWORD = "benchmark-password"
+
+
+class DynamoCallCounter:
+    # Counts every DynamoDB call, also across the several handlers of one benchmark
+
+    def __init__(self, client):
+        self.calls = 0
+        client.meta.events.register('after-call.dynamodb.*', self.count)
+
+    def count(self, **kwargs):
+        self.calls += 1
+
+
+def call(handler, **params):
+    response = handler({"queryStringParameters": params, "headers": {}}, None)
+    if response["statusCode"] not in [200, 304]:
+        raise RuntimeError("{} failed: {}".format(params, response.get("body")))
+    return json.loads(response["body"]) if response.get("body") else None
+
+
+def measure(function, runs, warmup, counter):
+    for _ in range(warmup):
+        function()
+
+    times = []
+    calls = []
+    for _ in range(runs):
+        counter.calls = 0
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+        calls.append(counter.calls)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times.sort()
+    return {
+        "min_ms": round(times[0], 4),
+        "ms": round(statistics.median(times), 4),
+        "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))], 4),
+        "alloc_bytes": peak,
+        "dynamodb_calls": max(calls),
+    }
+
+
+def setUpGames(modules, players):
+    # A started game per player count, its map full of buildings
+    tokens = {}
+    games = {}
+    for count in players:
+        names = ["bench{}_{}".format(count, number) for number in range(count)]
+        for name in names:
+            tokens[name] = call(modules["login"].lambda_handler, user=name, password=PASSWORD)["token"]
+        game_id = call(modules["modifyGame"].lambda_handler, token=tokens[names[0]], action="CREATE")["game_id"]
+        for name in names[1:]:
+            call(modules["modifyGame"].lambda_handler, token=tokens[name], action="JOIN", game_id=game_id)
+        call(modules["modifyGame"].lambda_handler, token=tokens[names[0]], action="START", game_id=game_id)
+
+        success, message, state = modules["play"].loadGameState(names[0], game_id)
+        for row in range(state.map_size):
+            for column in range(state.map_size):
+                state.setTile(row, column, (row + column) % len(state.building_types) + 1,
+                              (row * column) % state.max_level + 1, (row + column) % count + 1)
+        modules["play"].saveGameState(state, state.version)
+        games[count] = (game_id, names)
+    return tokens, games
+
+
+def defineBenchmarks(modules):
+    common = modules["common"]
+    mapCodec = modules["mapCodec"]
+    getGameStatus = modules["getGameStatus"]
+    params = modules["parameters"].getParams()
+
+    tokens, games = setUpGames(modules, [1, 2, 3, 4])
+    salt = os.urandom(32)
+    benchmarks = {}
+
+    benchmarks["generateHashedPassword"] = lambda: common.generateHashedPassword(PASSWORD, salt)
+    benchmarks["checkUser"] = lambda: common.checkUser("bench1_0", PASSWORD)
+
+    for count, (game_id, names) in games.items():
+        for map_format in ["packed", "json"]:
+            benchmarks["buildGameStatus/{}p/{}".format(count, map_format)] = (
+                lambda game_id=game_id, user=names[0], map_format=map_format:
+                getGameStatus.buildGameStatus(user, game_id, map_format))
+        benchmarks["buildGameStatus/{}p/delta".format(count)] = (
+            lambda game_id=game_id, user=names[0]: getGameStatus.buildGameStatus(user, game_id, "packed", 1))
+
+    # What startGame builds and serializes for the map of every game size
+    for map_size in params["map_size"]:
+        benchmarks["startGameMap/{}".format(map_size)] = (
+            lambda map_size=map_size: (mapCodec.dumpMap(mapCodec.emptyMap(map_size)),
+                                       mapCodec.dumpTileVersions(mapCodec.emptyTileVersions(map_size, 1))))
+
+    game_id, names = games[4]
+    token = tokens[names[0]]
+    lobby_token = tokens["bench1_0"]
+    benchmarks["handler/login"] = lambda: call(modules["login"].lambda_handler, user=names[0], password=PASSWORD)
+    benchmarks["handler/listAvailableGames"] = lambda: call(modules["listAvailableGames"].lambda_handler)
+    benchmarks["handler/getGameStatus"] = lambda: call(modules["getGameStatus"].lambda_handler, token=token, game_id=game_id)
+    benchmarks["handler/getGameStatus/since"] = lambda: call(
+        modules["getGameStatus"].lambda_handler, token=token, game_id=game_id, since_version="1")
+    benchmarks["handler/waitForUpdate"] = lambda: call(
+        modules["waitForUpdate"].lambda_handler, token=token, game_id=game_id, since_version="1", timeout="0")
+    benchmarks["handler/play/ASK_LOAN+PAY_LOAN"] = lambda: (
+        call(modules["play"].lambda_handler, token=token, game_id=game_id, action="ASK_LOAN", amount="100"),
+        call(modules["play"].lambda_handler, token=token, game_id=game_id, action="PAY_LOAN", amount="100"))
+
+    def createAndDelete():
+        # bench1_0 leaves its game so it can create (and delete) a new one every time
+        created = call(modules["modifyGame"].lambda_handler, token=lobby_token, action="CREATE")
+        call(modules["modifyGame"].lambda_handler, token=lobby_token, action="DELETE", game_id=created["game_id"])
+
+    call(modules["modifyGame"].lambda_handler, token=lobby_token, action="DELETE", game_id=games[1][0])
+    benchmarks["handler/modifyGame/CREATE+DELETE"] = createAndDelete
+
+    # The leaderboard write of a year end. The two players share a shard and
+    # end the year with the same points, so their rank counters are the same items
+    leaderboard = modules["leaderboard"]
+    shard_players = {}
+    for number in range(2 * leaderboard.LEADERBOARD_SHARDS + 1):
+        name = "bench_rank_{}".format(number)
+        shard_players.setdefault(leaderboard.leaderboardShard(name), []).append(name)
+    ranked = [names for names in shard_players.values() if len(names) >= 2][0][:2]
+
+    def yearEndPoints():
+        gained = dict((name, 30) for name in ranked)
+        modules["database"].client.transact_write_items(
+            TransactItems=leaderboard.pointsUpdates(gained, leaderboard.rankedTotals(ranked)))
+
+    benchmarks["yearEndPoints/shared-shard"] = yearEndPoints
+    return benchmarks
+
+
+def compare(results, baseline, latency_threshold, memory_threshold):
+    regressions = []
+    print("{:<40} {:>10} {:>10} {:>8} {:>12} {:>6}".format("benchmark", "min ms", "base ms", "change", "alloc", "calls"))
+    for name, result in results.items():
+        base = baseline.get(name)
+        notes = []
+        if base == None:
+            print("{:<40} {:>10.4f} {:>10} {:>8} {:>12} {:>6}  new".format(
+                name, result["min_ms"], "-", "-", result["alloc_bytes"], result["dynamodb_calls"]))
+            continue
+
+        change = (result["min_ms"] - base["min_ms"]) / base["min_ms"] if base["min_ms"] > 0 else 0
+        if change > latency_threshold and result["min_ms"] - base["min_ms"] > LATENCY_SLACK:
+            notes.append("latency")
+        if result["alloc_bytes"] > base["alloc_bytes"] * (1 + memory_threshold):
+            notes.append("allocations {} > {}".format(result["alloc_bytes"], base["alloc_bytes"]))
+        if result["dynamodb_calls"] > base["dynamodb_calls"]:
+            notes.append("dynamodb calls {} > {}".format(result["dynamodb_calls"], base["dynamodb_calls"]))
+
+        print("{:<40} {:>10.4f} {:>10.4f} {:>+7.1f}% {:>12} {:>6}  {}".format(
+            name, result["min_ms"], base["min_ms"], change * 100, result["alloc_bytes"], result["dynamodb_calls"],
+            "REGRESSION " + ", ".join(notes) if len(notes) != 0 else ""))
+        if len(notes) != 0:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths against the in-memory tables")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--filter", default="", help="only benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--latency-threshold", type=float, default=0.25, help="allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("--memory-threshold", type=float, default=0.10, help="allowed extra allocation, 0.10 is 10%%")
+    args = parser.parse_args()
+
+    # Trace lines would only add noise to the measurements
+    os.environ["TRACE_SAMPLE_RATE"] = "0"
+    startLocalDynamo()
+
+    import importlib
+    modules = {}
+    for name in ["common", "database", "getGameStatus", "leaderboard", "listAvailableGames", "login", "mapCodec",
+                 "modifyGame", "parameters", "play", "waitForUpdate"]:
+        modules[name] = importlib.import_module(name)
+
+    counter = DynamoCallCounter(modules["database"].client)
+    benchmarks = defineBenchmarks(modules)
+
+    results = {}
+    for name, function in benchmarks.items():
+        if args.filter in name:
+            results[name] = measure(function, args.runs, args.warmup, counter)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        baseline.update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        compare(results, {}, args.latency_threshold, args.memory_threshold)
+        print("Baseline saved to {}".format(args.baseline))
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        compare(results, {}, args.latency_threshold, args.memory_threshold)
+        print("No baseline at {}, run with --save to create it".format(args.baseline))
+        sys.exit(0)
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, args.latency_threshold, args.memory_threshold)
+    if len(regressions) != 0:
+        print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+        sys.exit(1)
+    print("No regressions")
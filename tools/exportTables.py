@@ -0,0 +1,314 @@
+"""Export of gameDB and playerDB for offline analytics.
+
+Every table is read with a parallel scan (Segment / TotalSegments), one
+worker per segment, and written as columnar files, CSV or Parquet:
+
+    python tools/exportTables.py --out export
+    python tools/exportTables.py --out export --segments 32 --max-rcu 500 --format parquet
+
+Uses the AWS credentials and region of the environment, like the lambdas.
+The workers share a read capacity budget (--max-rcu per second), measured
+with the capacity DynamoDB reports for every page, so the export does not
+take the capacity the game needs.
+
+Games are written as three tables: games, game_players (player_names and
+player_state, one row per player) and game_tiles (the map, one row per
+built tile), at their last version: the plays in journalDB after the
+snapshot are applied, like the lambdas load a game. Games evicted by the
+archiver are in the archive files only. Players are written without their
+credentials.
+
+Every segment writes its rows to numbered part files and records in
+export/checkpoint.json where its scan is after each part. Run the same
+command again to resume an interrupted export; a part written after the
+last checkpoint is written again under the same name.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from localDynamo import addLambdasToPath
+
+addLambdasToPath()
+
+from mapCodec import loadMap, tileToDict  # noqa: E402
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+# Columns of every output table, a part file always has all of them
+COLUMNS = {
+    "games": ["game_id", "status", "players", "map_size", "year", "turn", "action_done", "version",
+              "created_at", "matched"],
+    "game_players": ["game_id", "player_id", "position", "money", "debt", "accumulated_points"],
+    "game_tiles": ["game_id", "row", "column", "type", "level", "owner"],
+    "players": ["player_id", "last_connection", "active_game", "total_points", "matchmaking", "queued_at"],
+}
+
+# Parquet types, so all the parts of a table have the same schema. The
+# other columns are integers
+STRING_COLUMNS = ["game_id", "status", "player_id", "type", "owner", "last_connection", "active_game", "matchmaking"]
+BOOLEAN_COLUMNS = ["action_done", "matched"]
+
+# Output tables written from the items of every DynamoDB table
+OUTPUTS = {
+    "gameDB": ["games", "game_players", "game_tiles"],
+    "playerDB": ["players"],
+}
+
+
+def plainValue(value):
+    # Numbers as boto3 reads them are Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def decodeGame(item):
+    # Returns output table -> rows of one gameDB item
+    game_id = item["game_id"]
+    game = dict((name, plainValue(item.get(name))) for name in COLUMNS["games"])
+    rows = {"games": [game], "game_players": [], "game_tiles": []}
+
+    player_names = json.loads(item.get("player_names", "[]"))
+    player_state = item.get("player_state", {})
+    for position, name in enumerate(player_names):
+        state = player_state.get(name, {})
+        rows["game_players"].append({
+            "game_id": game_id,
+            "player_id": name,
+            "position": position + 1,
+            "money": plainValue(state.get("money")),
+            "debt": plainValue(state.get("debt")),
+            "accumulated_points": plainValue(state.get("accumulated_points")),
+        })
+
+    if "map" in item and "map_size" in item:
+        map_size = int(item["map_size"])
+        cells = map_size * map_size
+        tiles = loadMap(item["map"], map_size, player_names)
+        for index in range(cells):
+            if tiles[index] == 0:
+                continue
+            tile = tileToDict(tiles[index], tiles[cells + index], tiles[2 * cells + index], player_names)
+            rows["game_tiles"].append({
+                "game_id": game_id,
+                "row": index // map_size,
+                "column": index % map_size,
+                "type": tile["type"],
+                "level": tile["level"],
+                "owner": tile["owner"],
+            })
+    return rows
+
+
+def decodePlayer(item):
+    # hashed_pass and salt are never exported
+    return {"players": [dict((name, plainValue(item.get(name))) for name in COLUMNS["players"])]}
+
+
+DECODERS = {"gameDB": decodeGame, "playerDB": decodePlayer}
+
+
+class CapacityLimiter:
+    # Shared by the workers: the read capacity consumed stays under rate units
+    # per second on average. DynamoDB tells the capacity of a page once it was
+    # read, so a page can go over and the next ones wait for it
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.available = rate
+        self.updated = time.monotonic()
+
+    def consume(self, units):
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.rate, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            self.available -= units
+            wait = -self.available / self.rate if self.available < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Checkpoint:
+    # Where the scan of every segment is, written after every part file
+
+    def __init__(self, folder, settings):
+        self.path = os.path.join(folder, CHECKPOINT_FILE)
+        self.lock = threading.Lock()
+        self.state = {"settings": settings, "segments": {}}
+        if os.path.exists(self.path):
+            with open(self.path) as checkpoint_file:
+                self.state = json.load(checkpoint_file)
+            if self.state["settings"] != settings:
+                raise ValueError("{} was written by an export with other settings: {}".format(
+                    self.path, self.state["settings"]))
+
+    def segment(self, table, segment):
+        return self.state["segments"].get("{}/{}".format(table, segment),
+                                          {"last_key": None, "part": 0, "items": 0, "done": False})
+
+    def save(self, table, segment, progress):
+        with self.lock:
+            self.state["segments"]["{}/{}".format(table, segment)] = progress
+            with open(self.path + ".tmp", "w") as checkpoint_file:
+                json.dump(self.state, checkpoint_file, default=plainValue)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def parquetType(name):
+    import pyarrow
+    if name in STRING_COLUMNS:
+        return pyarrow.string()
+    if name in BOOLEAN_COLUMNS:
+        return pyarrow.bool_()
+    return pyarrow.int64()
+
+
+def writePart(folder, output, segment, part, rows, file_format):
+    # Written to a temporary name first, a part file is always complete
+    path = os.path.join(folder, output, "{}-{:04d}-{:05d}.{}".format(output, segment, part, file_format))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if file_format == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+        schema = pyarrow.schema([(name, parquetType(name)) for name in COLUMNS[output]])
+        columns = dict((name, [row[name] for row in rows]) for name in COLUMNS[output])
+        pyarrow.parquet.write_table(pyarrow.table(columns, schema=schema), path + ".tmp", compression="snappy")
+    else:
+        with open(path + ".tmp", "w", newline="") as part_file:
+            writer = csv.DictWriter(part_file, fieldnames=COLUMNS[output])
+            writer.writeheader()
+            writer.writerows(rows)
+    os.replace(path + ".tmp", path)
+
+
+def currentGame(item, limiter):
+    # The snapshot with the journal records after it, a lifecycle record
+    # means the snapshot changed since the scan read it (see journal.loadGameItem),
+    # the game is exported as it was before
+    import database
+    from journal import replay
+    records = []
+    query = database.keyQuery("game_id = :g AND seq > :v", {":g": item["game_id"], ":v": int(item.get("version", 0))},
+                              ReturnConsumedCapacity="TOTAL")
+    while True:
+        response = database.journalDB.query(**query)
+        limiter.consume(response.get("ConsumedCapacity", {}).get("CapacityUnits", 0))
+        records.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            break
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    for position, record in enumerate(records):
+        if "set" not in record:
+            records = records[:position]
+            break
+    return replay(item, records)
+
+
+def exportSegment(table, segment, args, limiter, checkpoint):
+    # Returns the number of items exported by this run
+    progress = checkpoint.segment(table.name, segment)
+    if progress["done"]:
+        return 0
+
+    decode = DECODERS[table.name]
+    rows = dict((output, []) for output in OUTPUTS[table.name])
+    buffered = 0
+    exported = 0
+    scan = {
+        "Segment": segment,
+        "TotalSegments": args.segments,
+        "Limit": args.page_size,
+        "ReturnConsumedCapacity": "TOTAL",
+    }
+    if progress["last_key"] != None:
+        scan["ExclusiveStartKey"] = progress["last_key"]
+
+    while True:
+        response = table.scan(**scan)
+        limiter.consume(response.get("ConsumedCapacity", {}).get("CapacityUnits", 0))
+        for item in response["Items"]:
+            if table.name == "gameDB":
+                item = currentGame(item, limiter)
+            for output, decoded in decode(item).items():
+                rows[output].extend(decoded)
+        buffered += len(response["Items"])
+
+        last_key = response.get("LastEvaluatedKey")
+        if last_key != None:
+            scan["ExclusiveStartKey"] = last_key
+        if buffered < args.items_per_part and last_key != None:
+            continue
+
+        # Every output of the part has its file, even without rows, so a
+        # resumed export overwrites all of them
+        for output in OUTPUTS[table.name]:
+            writePart(args.out, output, segment, progress["part"], rows[output], args.format)
+            rows[output] = []
+        exported += buffered
+        progress = {"last_key": last_key, "part": progress["part"] + 1, "items": progress["items"] + buffered,
+                    "done": last_key == None}
+        checkpoint.save(table.name, segment, progress)
+        buffered = 0
+
+        if last_key == None:
+            return exported
+
+
+def exportTables(tables, args):
+    # Returns table name -> items exported by this run
+    settings = {"segments": args.segments, "format": args.format, "items_per_part": args.items_per_part,
+                "tables": [table.name for table in tables]}
+    os.makedirs(args.out, exist_ok=True)
+    checkpoint = Checkpoint(args.out, settings)
+    limiter = CapacityLimiter(args.max_rcu)
+
+    exported = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for table in tables:
+            segments = range(args.segments)
+            counts = executor.map(lambda segment: exportSegment(table, segment, args, limiter, checkpoint), segments)
+            exported[table.name] = sum(counts)
+    return exported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export gameDB and playerDB to CSV or Parquet files")
+    parser.add_argument("--out", required=True, help="folder of the files and of the checkpoint")
+    parser.add_argument("--tables", nargs="+", default=["gameDB", "playerDB"], choices=["gameDB", "playerDB"])
+    parser.add_argument("--segments", type=int, default=16, help="TotalSegments of the parallel scans")
+    parser.add_argument("--workers", type=int, default=16, help="segments scanned at the same time")
+    parser.add_argument("--max-rcu", type=float, default=100.0, help="read capacity units per second for the export")
+    parser.add_argument("--page-size", type=int, default=100, help="items per Scan call")
+    parser.add_argument("--items-per-part", type=int, default=10000, help="items of a segment in one part file")
+    parser.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    args = parser.parse_args()
+
+    if args.format == "parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            parser.error("--format parquet needs pyarrow (pip install pyarrow)")
+
+    import database
+    tables = [getattr(database, name) for name in args.tables]
+
+    started = time.perf_counter()
+    try:
+        exported = exportTables(tables, args)
+    except ValueError as ex:
+        print(ex)
+        sys.exit(1)
+    elapsed = time.perf_counter() - started
+    for name in exported:
+        print("{}: {} items".format(name, exported[name]))
+    print("{:.1f}s".format(elapsed))
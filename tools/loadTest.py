@@ -0,0 +1,301 @@
+"""Concurrent load test of the handlers, replaying whole game sessions.
+
+Every simulated player is a thread that calls the lambda handlers directly,
+against the localDynamo tables with injected latency and throttling:
+
+    python tools/loadTest.py --sessions 25 --players 4 --years 2
+    python tools/loadTest.py --latency-ms 8 --jitter-ms 4 --throttle-rate 0.05
+
+A session is login, CREATE, listAvailableGames and JOIN by the other
+players, START, then every player polls getGameStatus (since_version) and
+plays its turns (a random BUILD or ASK_LOAN, then PASS) until the game has
+run --years years. endOfTurn runs on its own thread as the scheduled rule
+would. The owner DELETEs the game at the end.
+
+The report has the throughput and p50/p95/p99 latency per endpoint and
+action. It also counts calls that were rejected by the game rules, failed
+on a version conflict, or raised, plus the throttled DynamoDB requests
+(botocore retries those like it would against AWS).
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import threading
+import time
+
+from localDynamo import startLocalDynamo
+
+PASSWORD = "load-password"
+
+# Messages of a write that lost against a concurrent one
+CONFLICT_MESSAGES = ["modified by another request"]
+
+
+class RawBody:
+    # Enough of a urllib3 response for botocore to read a canned body
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class DynamoFaults:
+    # Sleeps before every DynamoDB request and answers some of them with a
+    # throttling error instead of applying them to the tables
+
+    def __init__(self, client, latency_ms, jitter_ms, throttle_rate, seed):
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self.requests = 0
+        self.throttled = 0
+        # More specific than the before-send handler of moto, so it is called first
+        client.meta.events.register('before-send.dynamodb', self.beforeSend)
+
+    def beforeSend(self, request, **kwargs):
+        # botocore sends the same request again when it retries, undo the rewrite below
+        original = getattr(request, "throttled_original", None)
+        if original != None:
+            request.headers["X-Amz-Target"], request.body = original
+            request.throttled_original = None
+
+        with self.lock:
+            self.requests += 1
+            delay = max(self.latency + self.rng.uniform(-self.jitter, self.jitter), 0)
+            throttle = self.rng.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+        if delay > 0:
+            time.sleep(delay)
+        if not throttle:
+            return None
+
+        # Every before-send handler runs and the first answer wins. Ours comes
+        # first, but moto would still apply the request, so it gets a read instead
+        request.throttled_original = (request.headers["X-Amz-Target"], request.body)
+        request.headers["X-Amz-Target"] = "DynamoDB_20120810.ListTables"
+        request.body = b"{}"
+
+        from botocore.awsrequest import AWSResponse
+        body = json.dumps({
+            "__type": "com.amazonaws.dynamodb.v20120810#ProvisionedThroughputExceededException",
+            "message": "Injected throttling",
+        }).encode('utf-8')
+        headers = {"Content-Type": "application/x-amz-json-1.0", "x-amzn-RequestId": "loadtest"}
+        return AWSResponse(request.url, 400, headers, RawBody(body))
+
+
+class Recorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+        self.messages = collections.Counter()
+
+    def record(self, key, elapsed, outcome, message=None):
+        with self.lock:
+            self.latencies[key].append(elapsed * 1000)
+            self.outcomes[key][outcome] += 1
+            if message != None and outcome != "ok":
+                self.messages["{} {}: {}".format(key[0], key[1], message)] += 1
+
+
+def percentile(values, share):
+    index = min(len(values) - 1, max(0, int(round(share * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class LoadTest:
+
+    def __init__(self, modules, recorder, args):
+        self.modules = modules
+        self.recorder = recorder
+        self.args = args
+        self.start_year = modules["parameters"].getParams()["start_year"]
+        self.stopped = threading.Event()
+
+    def call(self, endpoint, action=None, **params):
+        # Returns the decoded body, None if the call did not succeed
+        if action != None:
+            params["action"] = action
+        key = (endpoint, action or "-")
+        started = time.perf_counter()
+        try:
+            response = self.modules[endpoint].lambda_handler({"queryStringParameters": params, "headers": {}}, None)
+        except Exception as ex:
+            self.recorder.record(key, time.perf_counter() - started, "error", type(ex).__name__)
+            return None
+        elapsed = time.perf_counter() - started
+
+        # endOfTurn is not behind the API and returns its result as it is
+        if "statusCode" not in response:
+            self.recorder.record(key, elapsed, "ok")
+            return response
+
+        body = json.loads(response["body"]) if response.get("body") else None
+        if response["statusCode"] == 200:
+            self.recorder.record(key, elapsed, "ok")
+            return body
+        message = str(body)
+        if any(conflict in message for conflict in CONFLICT_MESSAGES):
+            self.recorder.record(key, elapsed, "conflict", message)
+        else:
+            self.recorder.record(key, elapsed, "rejected", message)
+        return None
+
+    def runEndOfTurn(self):
+        # The scheduled rule of the deployed stack
+        while not self.stopped.wait(self.args.end_of_turn_interval):
+            self.call("endOfTurn")
+
+    def runSession(self, session):
+        players = self.args.players
+        shared = {"game_id": None}
+        joined = threading.Barrier(players, timeout=self.args.timeout)
+        finished = threading.Barrier(players, timeout=self.args.timeout)
+        threads = [threading.Thread(target=self.runPlayer, args=(session, index, shared, joined, finished))
+                   for index in range(players)]
+        return threads
+
+    def runPlayer(self, session, index, shared, joined, finished):
+        rng = random.Random("{}-{}-{}".format(self.args.seed, session, index))
+        name = "load{}_{}".format(session, index)
+        answer = self.call("login", user=name, password=PASSWORD)
+        if answer == None:
+            joined.abort()
+            return
+        token = answer["token"]
+
+        try:
+            if index == 0:
+                answer = self.call("modifyGame", "CREATE", token=token)
+                if answer == None:
+                    joined.abort()
+                    return
+                shared["game_id"] = answer["game_id"]
+                joined.wait()
+                # The others have joined once the barrier opens
+                if self.call("modifyGame", "START", token=token, game_id=shared["game_id"]) == None:
+                    finished.abort()
+                    return
+            else:
+                # Wait for the owner to create the game, browsing the lobby meanwhile
+                while shared["game_id"] == None and not joined.broken:
+                    self.call("listAvailableGames", limit="20")
+                    time.sleep(self.args.poll_interval)
+                for attempt in range(5):
+                    if self.call("modifyGame", "JOIN", token=token, game_id=shared["game_id"]) != None:
+                        break
+                    time.sleep(rng.uniform(0, self.args.poll_interval))
+                else:
+                    joined.abort()
+                    return
+                joined.wait()
+
+            self.playGame(name, token, shared["game_id"], rng)
+            finished.wait()
+            if index == 0:
+                self.call("modifyGame", "DELETE", token=token, game_id=shared["game_id"])
+        except threading.BrokenBarrierError:
+            return
+
+    def playGame(self, name, token, game_id, rng):
+        deadline = time.time() + self.args.timeout
+        game = None
+        version = None
+        while time.time() < deadline:
+            params = {"token": token, "game_id": game_id}
+            if version != None:
+                params["since_version"] = str(version)
+            answer = self.call("getGameStatus", **params)
+            if answer != None and "unchanged" not in answer["status"]:
+                game = answer["status"]["game"]
+                version = game["version"]
+
+            if game != None:
+                if game["status"] == "FINISHED" or game["year"] >= self.start_year + self.args.years:
+                    return
+                player_names = game["player_names"]
+                if 1 <= game["turn"] <= len(player_names) and player_names[game["turn"] - 1] == name:
+                    self.playTurn(token, game_id, game["map_size"], rng)
+                    continue
+            time.sleep(self.args.poll_interval)
+
+    def playTurn(self, token, game_id, map_size, rng):
+        move = rng.random()
+        if move < 0.6:
+            self.call("play", "BUILD", token=token, game_id=game_id,
+                      coordinates="{},{}".format(rng.randrange(map_size), rng.randrange(map_size)),
+                      type=rng.choice(["HOUSE", "APARTMENT", "OFFICE", "SHOP"]), level="1")
+        elif move < 0.8:
+            self.call("play", "ASK_LOAN", token=token, game_id=game_id, amount="100")
+        self.call("play", "PASS", token=token, game_id=game_id)
+
+
+def report(recorder, faults, elapsed):
+    total = sum(len(values) for values in recorder.latencies.values())
+    print("{} calls in {:.1f}s, {:.1f} calls/s".format(total, elapsed, total / elapsed))
+    print("{:<20} {:<12} {:>7} {:>7} {:>8} {:>8} {:>6} {:>9} {:>9} {:>9}".format(
+        "endpoint", "action", "calls", "ok", "rejected", "conflict", "error", "p50 ms", "p95 ms", "p99 ms"))
+    for key in sorted(recorder.latencies):
+        values = sorted(recorder.latencies[key])
+        outcomes = recorder.outcomes[key]
+        print("{:<20} {:<12} {:>7} {:>7} {:>8} {:>8} {:>6} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            key[0], key[1], len(values), outcomes["ok"], outcomes["rejected"], outcomes["conflict"], outcomes["error"],
+            percentile(values, 0.50), percentile(values, 0.95), percentile(values, 0.99)))
+    print("DynamoDB requests {}, throttled {}".format(faults.requests, faults.throttled))
+    if len(recorder.messages) != 0:
+        print("Most common refusals:")
+        for message, count in recorder.messages.most_common(10):
+            print("  {:>6}  {}".format(count, message))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay concurrent game sessions against the handlers")
+    parser.add_argument("--sessions", type=int, default=10, help="games played at the same time")
+    parser.add_argument("--players", type=int, default=4, choices=[1, 2, 3, 4])
+    parser.add_argument("--years", type=int, default=2, help="years played before the game is deleted")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="seconds between getGameStatus polls")
+    parser.add_argument("--end-of-turn-interval", type=float, default=1.0, help="seconds between endOfTurn runs")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="added to every DynamoDB request")
+    parser.add_argument("--jitter-ms", type=float, default=2.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of DynamoDB requests throttled")
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds a session may take")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ["TRACE_SAMPLE_RATE"] = "0"
+    startLocalDynamo()
+
+    import importlib
+    modules = {}
+    for name in ["database", "endOfTurn", "getGameStatus", "listAvailableGames", "login", "modifyGame",
+                 "parameters", "play"]:
+        modules[name] = importlib.import_module(name)
+
+    faults = DynamoFaults(modules["database"].client, args.latency_ms, args.jitter_ms, args.throttle_rate, args.seed)
+    recorder = Recorder()
+    test = LoadTest(modules, recorder, args)
+
+    ticker = threading.Thread(target=test.runEndOfTurn, daemon=True)
+    ticker.start()
+
+    started = time.perf_counter()
+    threads = []
+    for session in range(args.sessions):
+        threads.extend(test.runSession(session))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    test.stopped.set()
+
+    report(recorder, faults, elapsed)
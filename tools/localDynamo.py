@@ -0,0 +1,157 @@
+"""In-memory stand-in for the Bubble DynamoDB tables.
+
+Uses moto, so the lambdas run unchanged against it:
+
+    pip install boto3 moto
+
+Call startLocalDynamo() before the first request is made. Table
+definitions mirror deploy/template.yml and must be kept in sync with it.
+"""
+import os
+import sys
+import tempfile
+import threading
+
+LAMBDAS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "lambdas")
+
+TABLES = [
+    {
+        "TableName": "gameDB",
+        "BillingMode": "PAY_PER_REQUEST",
+        "AttributeDefinitions": [
+            {"AttributeName": "game_id", "AttributeType": "S"},
+            {"AttributeName": "lobby", "AttributeType": "S"},
+            {"AttributeName": "created_at", "AttributeType": "N"},
+            {"AttributeName": "year_end", "AttributeType": "S"},
+            {"AttributeName": "archive", "AttributeType": "S"},
+        ],
+        "KeySchema": [{"AttributeName": "game_id", "KeyType": "HASH"}],
+        "GlobalSecondaryIndexes": [
+            {
+                "IndexName": "lobby-index",
+                "KeySchema": [
+                    {"AttributeName": "lobby", "KeyType": "HASH"},
+                    {"AttributeName": "created_at", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["players", "player_names"]},
+            },
+            {
+                "IndexName": "year-end-index",
+                "KeySchema": [{"AttributeName": "year_end", "KeyType": "HASH"}],
+                "Projection": {"ProjectionType": "KEYS_ONLY"},
+            },
+            {
+                "IndexName": "archive-index",
+                "KeySchema": [{"AttributeName": "archive", "KeyType": "HASH"}],
+                "Projection": {"ProjectionType": "KEYS_ONLY"},
+            },
+        ],
+    },
+    {
+        "TableName": "playerDB",
+        "BillingMode": "PAY_PER_REQUEST",
+        "AttributeDefinitions": [
+            {"AttributeName": "player_id", "AttributeType": "S"},
+            {"AttributeName": "matchmaking", "AttributeType": "S"},
+            {"AttributeName": "queued_at", "AttributeType": "N"},
+            {"AttributeName": "leaderboard_shard", "AttributeType": "S"},
+            {"AttributeName": "total_points", "AttributeType": "N"},
+        ],
+        "KeySchema": [{"AttributeName": "player_id", "KeyType": "HASH"}],
+        "GlobalSecondaryIndexes": [
+            {
+                "IndexName": "matchmaking-index",
+                "KeySchema": [
+                    {"AttributeName": "matchmaking", "KeyType": "HASH"},
+                    {"AttributeName": "queued_at", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "KEYS_ONLY"},
+            },
+            {
+                "IndexName": "leaderboard-index",
+                "KeySchema": [
+                    {"AttributeName": "leaderboard_shard", "KeyType": "HASH"},
+                    {"AttributeName": "total_points", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "KEYS_ONLY"},
+            },
+        ],
+    },
+    {
+        "TableName": "journalDB",
+        "BillingMode": "PAY_PER_REQUEST",
+        "AttributeDefinitions": [
+            {"AttributeName": "game_id", "AttributeType": "S"},
+            {"AttributeName": "seq", "AttributeType": "N"},
+        ],
+        "KeySchema": [
+            {"AttributeName": "game_id", "KeyType": "HASH"},
+            {"AttributeName": "seq", "KeyType": "RANGE"},
+        ],
+    },
+    {
+        "TableName": "archiveDB",
+        "BillingMode": "PAY_PER_REQUEST",
+        "AttributeDefinitions": [{"AttributeName": "game_id", "AttributeType": "S"}],
+        "KeySchema": [{"AttributeName": "game_id", "KeyType": "HASH"}],
+    },
+    {
+        "TableName": "leaderboardDB",
+        "BillingMode": "PAY_PER_REQUEST",
+        "AttributeDefinitions": [
+            {"AttributeName": "leaderboard_shard", "AttributeType": "S"},
+            {"AttributeName": "points_bucket", "AttributeType": "N"},
+        ],
+        "KeySchema": [
+            {"AttributeName": "leaderboard_shard", "KeyType": "HASH"},
+            {"AttributeName": "points_bucket", "KeyType": "RANGE"},
+        ],
+    },
+    {
+        "TableName": "requestDB",
+        "BillingMode": "PAY_PER_REQUEST",
+        "AttributeDefinitions": [{"AttributeName": "request_id", "AttributeType": "S"}],
+        "KeySchema": [{"AttributeName": "request_id", "KeyType": "HASH"}],
+    },
+]
+
+
+def addLambdasToPath():
+    if LAMBDAS_FOLDER not in sys.path:
+        sys.path.insert(0, LAMBDAS_FOLDER)
+
+
+def startLocalDynamo():
+    # Fake credentials so nothing can reach a real account
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+    os.environ["AWS_ACCESS_KEY_ID"] = "local"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "local"
+    os.environ.pop("AWS_SESSION_TOKEN", None)
+    os.environ.setdefault("SESSION_SECRET", "local-session-secret-local-session-secret")
+    # A folder stands in for the archive bucket
+    os.environ.setdefault("ARCHIVE_DIR", os.path.join(tempfile.gettempdir(), "bubble-archive"))
+
+    from moto import mock_aws
+    import boto3
+
+    mock = mock_aws()
+    mock.start()
+
+    # DynamoDB applies every request atomically and transactions in isolation.
+    # moto has no locking, so requests made by several threads (loadTest.py)
+    # are applied one at a time
+    from moto.dynamodb.responses import DynamoHandler
+    lock = threading.Lock()
+    call_action = DynamoHandler.call_action
+
+    def serializedCallAction(self):
+        with lock:
+            return call_action(self)
+    DynamoHandler.call_action = serializedCallAction
+
+    client = boto3.client("dynamodb")
+    for table in TABLES:
+        client.create_table(**table)
+
+    addLambdasToPath()
+    return mock
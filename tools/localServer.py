@@ -0,0 +1,171 @@
+"""Local asyncio HTTP server for the Bubble API.
+
+Serves every endpoint of deploy/template.yml from this process against the
+in-memory tables of localDynamo:
+
+    python tools/localServer.py --port 8080
+    curl "localhost:8080/login?user=a&password=b"
+
+/waitForUpdate is pushed instead of polled here: the game write path calls
+common.notifyGameChanged, which wakes the waiting requests of that game.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+from urllib.parse import urlsplit, parse_qsl
+
+from localDynamo import addLambdasToPath, startLocalDynamo
+
+addLambdasToPath()
+
+import router  # noqa: E402
+
+REASONS = {200: "OK", 304: "Not Modified", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class GameWatchers:
+    # game_id -> futures of requests waiting for that game to change
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiters = {}
+
+    def onGameChanged(self, game_id, version):
+        # Called from the executor threads running the handlers
+        self.loop.call_soon_threadsafe(self.wake, game_id)
+
+    def wake(self, game_id):
+        for future in self.waiters.pop(game_id, []):
+            if not future.done():
+                future.set_result(True)
+
+    def watch(self, game_id):
+        future = self.loop.create_future()
+        self.waiters.setdefault(game_id, []).append(future)
+        return future
+
+    def unwatch(self, game_id, future):
+        if future in self.waiters.get(game_id, []):
+            self.waiters[game_id].remove(future)
+
+
+def jsonResponse(status_code, answer):
+    return {"statusCode": status_code, "headers": {"Content-Type": "application/json"}, "body": json.dumps(answer)}
+
+
+async def waitForUpdate(watchers, params):
+    # Same contract as waitForUpdate.lambda_handler, but instead of polling
+    # the handler is only re-run when the write path reports a change
+    import waitForUpdate as lambdaWaitForUpdate
+
+    timeout = lambdaWaitForUpdate.DEFAULT_TIMEOUT
+    if "timeout" in params:
+        if not params["timeout"].isdigit():
+            return jsonResponse(500, "timeout must be a number")
+        timeout = min(int(params["timeout"]), lambdaWaitForUpdate.MAX_TIMEOUT)
+    deadline = time.time() + timeout
+
+    loop = asyncio.get_running_loop()
+    event = {"queryStringParameters": dict(params, timeout="0")}
+    game_id = params.get("game_id")
+
+    while True:
+        # Watch before checking so a change in between is not missed
+        future = watchers.watch(game_id)
+        try:
+            response = await loop.run_in_executor(None, lambdaWaitForUpdate.lambda_handler, event, None)
+            if response["statusCode"] != 200 or not json.loads(response["body"])["status"].get("unchanged"):
+                return response
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return response
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                return response
+        finally:
+            watchers.unwatch(game_id, future)
+
+
+async def dispatch(watchers, method, target, headers):
+    url = urlsplit(target)
+    params = dict(parse_qsl(url.query, keep_blank_values=True))
+
+    if url.path == "/waitForUpdate":
+        return await waitForUpdate(watchers, params)
+
+    if url.path not in router.ROUTES:
+        return jsonResponse(404, "Unknown path")
+
+    # Everything goes through the router, as in a UseRouter deploy
+    event = {
+        "httpMethod": method,
+        "path": url.path,
+        "headers": headers,
+        "queryStringParameters": params if len(params) != 0 else None,
+    }
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, router.lambda_handler, event, None)
+
+
+async def handleConnection(watchers, reader, writer):
+    try:
+        request_line = await reader.readline()
+        if not request_line:
+            return
+        method, target, _ = request_line.decode('latin-1').split(" ", 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip()] = value.strip()
+
+        try:
+            response = await dispatch(watchers, method, target, headers)
+        except Exception as ex:
+            response = jsonResponse(500, "Internal error: " + str(ex))
+
+        body = response.get("body", "")
+        if response.get("isBase64Encoded"):
+            body = base64.b64decode(body)
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        status_code = response["statusCode"]
+
+        head = "HTTP/1.1 {} {}\r\n".format(status_code, REASONS.get(status_code, ""))
+        for name, value in response.get("headers", {}).items():
+            head += "{}: {}\r\n".format(name, value)
+        head += "Content-Length: {}\r\nConnection: close\r\n\r\n".format(len(body))
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    import common
+
+    watchers = GameWatchers(asyncio.get_running_loop())
+    common.addGameChangeListener(watchers.onGameChanged)
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handleConnection(watchers, reader, writer), host, port)
+    print("Serving Bubble on http://{}:{}".format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Bubble API locally against in-memory tables")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    startLocalDynamo()
+    asyncio.run(serve(args.host, args.port))
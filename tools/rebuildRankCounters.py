@@ -0,0 +1,24 @@
+"""Counts the ranked players of leaderboard-index into leaderboardDB.
+
+The rank counters are kept up to date by the writes of total_points (see
+leaderboard.pointsUpdates). Players ranked before leaderboardDB existed are
+not counted yet, this writes every counter again from the index:
+
+    python tools/rebuildRankCounters.py
+
+Uses the AWS credentials and region of the environment, like the lambdas.
+Run it while no year ends, a total written during the rebuild may be
+counted twice or not at all.
+"""
+import argparse
+
+from localDynamo import addLambdasToPath
+
+addLambdasToPath()
+
+
+if __name__ == "__main__":
+    argparse.ArgumentParser(description="Rebuild the rank counters of leaderboardDB").parse_args()
+
+    from leaderboard import rebuildRankCounters
+    print("{} counters written".format(rebuildRankCounters()))
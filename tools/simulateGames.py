@@ -0,0 +1,77 @@
+"""Offline simulation of the play engine, no database involved.
+
+Random players build, upgrade, destroy and take loans on an in-memory
+GameState, every year ends with GameState.endOfYear until the game finishes,
+and the run reports how many turns per second the engine does:
+
+    python tools/simulateGames.py --games 100 --players 4
+"""
+import argparse
+import random
+import time
+
+from localDynamo import addLambdasToPath
+
+addLambdasToPath()
+
+from engine import GameState  # noqa: E402
+from mapCodec import emptyMap, emptyTileVersions  # noqa: E402
+from parameters import getParams  # noqa: E402
+
+
+def newGameState(game_id, players):
+    params = getParams()
+    player_names = ["player" + str(number) for number in range(players)]
+    map_size = params["map_size"][players - 1]
+    money = {name: {"money": params["initial_money"], "debt": 0, "accumulated_points": 0, "version": 1} for name in player_names}
+    return GameState(game_id, player_names, map_size, emptyMap(map_size), emptyTileVersions(map_size, 1),
+                     1, params["start_year"], 1, False, money)
+
+
+def playTurn(state, rng):
+    # One random move for the current player, then pass
+    user = state.currentPlayer()
+    row = rng.randrange(state.map_size)
+    column = rng.randrange(state.map_size)
+    move = rng.random()
+    if move < 0.5:
+        state.build(user, row, column, rng.choice(state.building_types), rng.randint(1, state.max_level))
+    elif move < 0.7:
+        state.upgrade(user, row, column, rng.randint(1, state.max_level))
+    elif move < 0.8:
+        state.destroy(user, row, column)
+    elif move < 0.9:
+        state.askLoan(user, rng.randint(1, 10) * 100)
+    else:
+        state.payLoan(user, rng.randint(1, 10) * 100)
+    state.passTurn(user)
+
+
+def simulate(games, players, years, seed):
+    rng = random.Random(seed)
+    turns = 0
+    for game in range(games):
+        state = newGameState(str(game), players)
+        for year in range(years):
+            while state.currentPlayer() != None:
+                playTurn(state, rng)
+                turns += 1
+            # What endOfTurn does: interest, income, points, and the game
+            # finishes at finish_year
+            if state.endOfYear():
+                break
+    return turns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate random games with the play engine")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--players", type=int, default=4, choices=[1, 2, 3, 4])
+    parser.add_argument("--years", type=int, default=25, help="years per game, a game stops earlier at finish_year")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    turns = simulate(args.games, args.players, args.years, args.seed)
+    elapsed = time.perf_counter() - start
+    print("{} turns in {:.2f}s, {:.0f} turns/s".format(turns, elapsed, turns / elapsed))